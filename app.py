@@ -1,14 +1,44 @@
 import requests
 import pandas as pd
+import numpy as np
 import json
 import os
-from typing import List, Any, Union
+from typing import List, Any, Union, Tuple
 import operator
+import hashlib
 import time
-import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+from log import log_request, logger
+from tracing import traced, current_span
+from intervals import IntervalTree
+from breaker import get_breaker
 
 _API = "https://api.krakenflex.systems/interview-tests-mock-api/v1"
 
+# one session for all requests, so the connections are reused between the requests
+_session = requests.Session()
+
+# a request that gets no answer in this time fails and counts as a failure of its endpoint's circuit breaker
+_TIMEOUT_IN_SECONDS = 30
+
+# set by use_ledger, post_outages skips the payloads it has already posted
+_ledger = None
+
+# returned by post_outages instead of a response when the ledger has the payload and nothing is sent
+SKIPPED = object()
+
+
+class HTTPStatusError(Exception):
+    """Raised by `get` and `post` for the status codes that will not change by trying again(400, 403, 404)."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
 
 def get_x_api_key() -> str:
     """
@@ -30,6 +60,15 @@ def get_x_api_key() -> str:
     return x_api_key
 
 
+def _record_outcome(breaker, response: requests.Response) -> None:
+    """Tell the circuit breaker if the server failed(5xx) or answered the request."""
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+@traced()
 def get(
     endpoint: str = None,
     headers={},
@@ -45,41 +84,98 @@ def get(
         headers (dict): A dictionary of headers to include in the request.
         max_retry (int): The max number of times to retry the request
         wait_time_in_seconds (int): wait time between retries.
-        **kwargs: Additional args
+        **kwargs: Additional args, `params` is sent as the query string.
 
     Returns:
-        requests.Response: The server's response to the GET request.
+        requests.Response: The server's response to the GET request. The status code is 200 or
+        304 if a conditional request is sent(If-None-Match, If-Modified-Since headers) and the resource is not modified.
 
     Raises:
         ValueError: If `endpoint` is not provided.
-         Exception: If the request fails with a status code of 400, 403, 404 or all retry attempts are exhausted.
+         HTTPStatusError: If the request fails with a status code of 400, 403 or 404.
+        CircuitOpenError: If the endpoint keeps failing and its circuit breaker is open.
+        requests.RequestException: If the request times out or cannot connect.
 
     """
 
     if not endpoint:
         raise ValueError("Please provide an endpoint")
 
+    attempt = kwargs.pop("attempt", 1)
     url = f"{_API}/{endpoint}"
+    current_span().set_attribute("endpoint", endpoint)
+    current_span().set_attribute("attempt", attempt)
+
+    breaker = get_breaker(endpoint)
+    breaker.before_request()
 
+    start = time.perf_counter()
+    response = None
     try:
-        response = requests.get(url=url, headers=headers)
+        response = _session.get(
+            url=url,
+            headers=headers,
+            params=kwargs.get("params"),
+            timeout=_TIMEOUT_IN_SECONDS,
+        )
+        current_span().set_attribute("status", response.status_code)
+        _record_outcome(breaker, response)
         response.raise_for_status()
-        logging.basicConfig(level=logging.WARNING)
 
-        if response.status_code == 200:
+        # 304 is the answer of a conditional request(If-None-Match) when the resource is not modified
+        if response.status_code in (200, 304):
+            log_request(
+                "GET",
+                endpoint,
+                response.status_code,
+                time.perf_counter() - start,
+                attempt,
+            )
             return response
 
     except:
+        latency = time.perf_counter() - start
+
+        if response is None:
+            breaker.record_failure()
+            log_request("GET", endpoint, None, latency, attempt)
+            raise
+
+        # 400, 403 and 404 will not change by trying again, even if retries are left
+        if response.status_code in (400, 403, 404):
+            mapping_status_code = {
+                400: "We cannot process your request because it doesn't match the required format.",
+                403: "You do not have the required permissions to make this request. Please set your api key as an env variable or check your Apikey is correct.",
+                404: "You have requested a resource that does not exist. Pls check your endpoint url.",
+            }
+
+            log_request("GET", endpoint, response.status_code, latency, attempt)
+            raise HTTPStatusError(
+                f"Error: Request failed with status code {response.status_code}, {mapping_status_code[response.status_code]}.",
+                response.status_code,
+            )
+
         if max_retry <= 0:
+            log_request(
+                "GET",
+                endpoint,
+                response.status_code,
+                latency,
+                attempt,
+                "Request failed, no retries left",
+            )
             return
 
         max_retry -= 1
 
         if response.status_code in (429, 500):
-            logger = logging.getLogger(f" Status code {response.status_code}")
-
-            logger.warning(
-                f"Request failed,The request will be send again after {wait_time_in_seconds}s. Remaining trial count is {max_retry}"
+            log_request(
+                "GET",
+                endpoint,
+                response.status_code,
+                latency,
+                attempt,
+                f"Request failed, it will be sent again after {wait_time_in_seconds}s. Remaining trial count is {max_retry}",
             )
 
             time.sleep(wait_time_in_seconds)
@@ -88,27 +184,18 @@ def get(
                 headers=headers,
                 max_retry=max_retry,
                 wait_time_in_seconds=wait_time_in_seconds,
+                attempt=attempt + 1,
                 **kwargs,
             )
 
-        if response.status_code in (400, 403, 404):
-            mapping_status_code = {
-                400: "We cannot process your request because it doesn't match the required format.",
-                403: "You do not have the required permissions to make this request. Please set your api key as an env variable or check your Apikey is correct.",
-                404: "You have requested a resource that does not exist. Pls check your endpoint url.",
-            }
-
-            raise Exception(
-                f"Error: Request failed with status code {response.status_code}, {mapping_status_code[response.status_code]}."
-            )
-
 
-def parse_json(text: str = None) -> Union[list, dict]:
+@traced()
+def parse_json(text: Union[bytes, str] = None) -> Union[list, dict]:
     """
     Parse a JSON string and return into a dict or list.
 
     Args:
-        text (str): A JSON-formatted string to parse.
+        text (Union[bytes, str]): A JSON-formatted string or bytes(e.g. response.content) to parse.
 
     Returns:
         The resulting dict or list object.
@@ -119,15 +206,223 @@ def parse_json(text: str = None) -> Union[list, dict]:
     if not text:
         raise ValueError("Text must be provided")
 
-    return json.loads(text)
+    return codec.loads(text)
 
 
-def get_outages(headers={}) -> List[dict]:
+class _Call:
+    """A request in flight, the callers waiting for it get its result or error."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_single_flight_stats = {"calls": 0, "coalesced": 0}
+
+
+def _single_flight(key: tuple, func):
+    """
+    Run `func` once for all the callers that ask for the same key at the same time.
+
+    The first caller runs `func`, the callers that come while it is running wait for it and get the same result
+    or the same exception. Once it is finished, the next caller runs `func` again.
+    """
+    with _in_flight_lock:
+        _single_flight_stats["calls"] += 1
+        call = _in_flight.get(key)
+
+        if call is not None:
+            _single_flight_stats["coalesced"] += 1
+            leader = False
+        else:
+            call = _in_flight[key] = _Call()
+            leader = True
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = func()
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        call.done.set()
+
+    return call.result
+
+
+def get_single_flight_stats() -> dict:
+    """
+    Get the counters of `get_json` calls.
+
+    Returns:
+        A dict with "calls", the number of calls, and "coalesced", the number of calls that shared the request
+        of another call instead of sending their own.
+    """
+    with _in_flight_lock:
+        return dict(_single_flight_stats)
+
+
+def get_json(endpoint: str = None, headers={}) -> Union[list, dict]:
+    """
+    Sends a GET request and parses the JSON response.
+
+    Concurrent calls with the same endpoint and headers share one request and get the same parsed object,
+    so the callers must not modify it.
+
+    Args:
+        endpoint (str): The endpoint to send the GET request to.
+        headers (dict): A dictionary of headers to include in the request.
+
+    Returns:
+        The parsed response.
+
+    Raises:
+        ValueError: If `endpoint` is not provided.
+        Exception: If the request fails.
+    """
+    key = (endpoint, tuple(sorted(headers.items())))
+    return _single_flight(
+        key, lambda: parse_json(get(endpoint=endpoint, headers=headers).content)
+    )
+
+
+@traced()
+def get_outages_page(
+    headers: dict,
+    offset: int,
+    limit: int,
+    max_page_retry: int = 3,
+    backoff_in_seconds: float = 1.0,
+) -> List[dict]:
+    """
+    Fetches one page of the outages, retrying only that page if it fails.
+
+    The page is sent without the retries of `get`, the failed attempts(5xx, 429, timeouts) are retried here
+    after `backoff_in_seconds`, doubled after each attempt.
+
+    Args:
+        headers (dict): A dictionary of headers to include in the request.
+        offset (int): Position of the first outage of the page.
+        limit (int): Max number of outages in the page.
+        max_page_retry (int): The max number of times to fetch the page again after a failure.
+        backoff_in_seconds (float): Wait time before the first retry.
+
+    Returns:
+        The outages of the page.
+
+    Raises:
+        HTTPStatusError: If the page fails with a status code of 400, 403 or 404.
+        CircuitOpenError: If the circuit breaker of the outages endpoint is open.
+        Exception: If the page cannot be fetched after all retries.
+    """
+    error = None
+    for attempt in range(max_page_retry + 1):
+        if attempt:
+            time.sleep(backoff_in_seconds * 2 ** (attempt - 1))
+
+        try:
+            r = get(
+                endpoint="outages",
+                headers=headers,
+                max_retry=0,
+                params={"offset": offset, "limit": limit},
+            )
+        except requests.RequestException as e:
+            error = e
+            continue
+
+        if r is not None:
+            return parse_json(r.content)
+        error = "the server answered with an error"
+
+    raise Exception(f"Error: Outages page at offset {offset} failed, {error}")
+
+
+@traced()
+def get_outages_paginated(
+    headers={},
+    page_size: int = 1000,
+    workers: int = 4,
+    max_page_retry: int = 3,
+    max_pages: int = 10_000,
+) -> List[dict]:
+    """
+    Fetches the outages page by page, fetching `workers` pages at the same time.
+
+    The pages are requested with offset and limit query parameters until a page has less than `page_size` outages.
+    Each page is retried on its own, so a failing page doesn't start the whole download again.
+    If the server doesn't page the outages(a page is longer than `page_size` or the same as the page before it),
+    the outages are fetched at once with `get_json`.
+
+    Args:
+        headers (dict): A dictionary of headers to include in the request.
+        page_size (int): Number of outages in a page.
+        workers (int): Number of pages fetched at the same time.
+        max_page_retry (int): The max number of times to fetch a failed page again.
+        max_pages (int): The max number of pages to fetch.
+
+    Returns:
+        The outages in the order of the pages.
+
+    Raises:
+        Exception: If a page cannot be fetched after all retries or there are more than `max_pages` pages.
+    """
+    outages = []
+    offset = 0
+    previous_page = None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            if offset // page_size >= max_pages:
+                raise Exception(
+                    f"Error: Outages have more than {max_pages} pages of {page_size}"
+                )
+
+            offsets = [offset + i * page_size for i in range(workers)]
+            pages = list(
+                pool.map(
+                    lambda page_offset: get_outages_page(
+                        headers, page_offset, page_size, max_page_retry
+                    ),
+                    offsets,
+                )
+            )
+
+            for page in pages:
+                if len(page) > page_size or (page and page == previous_page):
+                    logger.warning(
+                        "Outages are not paged by the server, they are fetched at once",
+                        extra={"fields": {"page_size": page_size, "rows": len(page)}},
+                    )
+                    return get_json(endpoint="outages", headers=headers)
+
+                outages.extend(page)
+                previous_page = page
+                if len(page) < page_size:
+                    return outages
+
+            offset += workers * page_size
+
+
+@traced()
+def get_outages(headers={}, page_size: int = None, workers: int = 4) -> List[dict]:
     """
     Fetches a list of outages from a REST API.
 
     Args:
         headers (dict): A dictionary of headers to include in the request.
+        page_size (int): If given, the outages are fetched in pages of this size with `get_outages_paginated`.
+        workers (int): Number of pages fetched at the same time when `page_size` is given.
 
     Returns:
         A list of outages and their information(id,begin,end).
@@ -135,13 +430,18 @@ def get_outages(headers={}) -> List[dict]:
     Raises:
         Exception: If the request fails or returns an unexpected response status code.
     """
+    if page_size:
+        return get_outages_paginated(
+            headers=headers, page_size=page_size, workers=workers
+        )
+
     endpoint = "outages"
-    r = get(endpoint=endpoint, headers=headers)
-    outages = parse_json(r.text)
+    outages = get_json(endpoint=endpoint, headers=headers)
 
     return outages
 
 
+@traced()
 def get_site_info(site_id: str = None, headers={}) -> dict:
     """
     Retrieve information about a site by its ID.
@@ -161,12 +461,12 @@ def get_site_info(site_id: str = None, headers={}) -> dict:
         raise ValueError("Site id must be provided")
 
     endpoint = f"site-info/{site_id}"
-    r = get(endpoint=endpoint, headers=headers)
-    site_info = parse_json(r.text)
+    site_info = get_json(endpoint=endpoint, headers=headers)
 
     return site_info
 
 
+@traced()
 def create_df(data) -> pd.DataFrame:
     """
     Convert iterable objects to a pandas DataFrame.
@@ -183,12 +483,84 @@ def create_df(data) -> pd.DataFrame:
     return pd.DataFrame(data)
 
 
+def _iso_text(stamps: np.ndarray) -> np.ndarray:
+    """Write datetime64 values like '2022-01-01T00:00:00.000Z'."""
+    return np.char.add(np.datetime_as_string(stamps, unit="ms"), "Z")
+
+
+def _typed_timestamps(values: pd.Series) -> pd.Series:
+    """
+    Convert ISO timestamps like '2022-01-01T00:00:00.000Z' to naive datetime64[ms] values in UTC.
+
+    Only timestamps that `df_to_json` writes back with exactly the same text are converted.
+    Other values are returned as they are.
+    """
+    if not pd.api.types.is_string_dtype(values):
+        return values
+
+    text = values.to_numpy(dtype=str)
+    try:
+        stamps = np.char.rstrip(text, "Z").astype("datetime64[ms]")
+    except ValueError:
+        return values
+
+    if not (_iso_text(stamps) == text).all():
+        return values
+
+    return pd.Series(stamps, index=values.index, name=values.name)
+
+
+@traced()
+def create_typed_dfs(
+    outages: List[dict], devices: List[dict], key: str = "id"
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Create the outage and device dfs with compact column types.
+
+    The ids of both dfs share one categorical type, so every row keeps an integer code instead of its own id string
+    and `df_join` joins them on the codes. begin and end become datetime64 and names categorical.
+    `df_to_json` converts them back to the same JSON as the plain dfs of `create_df`.
+
+    Args:
+        outages (List[dict]): Outages with id, begin and end fields.
+        devices (List[dict]): Devices with id and name fields.
+        key (str): The id column.
+
+    Returns:
+        A tuple of the outage df and the device df.
+    """
+    df_outages = create_df(outages)
+    df_devices = create_df(devices)
+
+    ids = set()
+    for df in (df_outages, df_devices):
+        if key in df:
+            ids.update(df[key].unique())
+
+    # sorted categories keep the order of the codes the same as the order of the ids
+    id_dtype = pd.CategoricalDtype(sorted(ids))
+
+    for df in (df_outages, df_devices):
+        if key in df:
+            df[key] = df[key].astype(id_dtype)
+
+    for column in ("begin", "end"):
+        if column in df_outages:
+            df_outages[column] = _typed_timestamps(df_outages[column])
+
+    if "name" in df_devices:
+        df_devices["name"] = df_devices["name"].astype("category")
+
+    return df_outages, df_devices
+
+
+@traced()
 def filter_by_column(data: List[dict], column: str, value: Any, op: str):
     """
     Filters a list of dictionaries by a given column, value and comparison operator.
 
     Args:
-        data (List[dict]): data to filter
+        data (List[dict]): data to filter, an object with a `filter_by_column` method(e.g. an OutageSnapshot) is filtered by that method
         column (str): filter column
         value (Any): The value to compare against.
         op (str): The comparison operator to use. Allowed values are: ">", ">=", "<=", "<", "=", "in".
@@ -199,6 +571,10 @@ def filter_by_column(data: List[dict], column: str, value: Any, op: str):
     Raises:
         ValueError: If the comparison operator is not allowed.
     """
+    # columnar data(e.g. snapshot.OutageSnapshot) filters itself without building the rows
+    if hasattr(data, "filter_by_column"):
+        return data.filter_by_column(column, value, op)
+
     mapping = {
         ">": operator.gt,
         ">=": operator.ge,
@@ -217,6 +593,7 @@ def filter_by_column(data: List[dict], column: str, value: Any, op: str):
     return [row for row in data if op(row[column], value)]
 
 
+@traced()
 def filter_by_another_json(
     first_data: Union[dict, List[dict]],
     first_filter_column_name: str,
@@ -252,12 +629,177 @@ def filter_by_another_json(
     )
 
 
+@traced()
+def coalesce_outages(data: List[dict], key: str = "id") -> Tuple[List[dict], int]:
+    """
+    Merge the overlapping or adjacent outages of each device into one outage.
+
+    The outages are sorted by (key, begin) and swept once, an outage that begins before or when the previous
+    one of the same device ends is merged into it. The merged outage keeps the fields of the first outage and
+    the latest end.
+
+    Args:
+        data (List[dict]): Outages with key, begin and end fields.
+        key (str): The column that identifies the device.
+
+    Returns:
+        A tuple of the coalesced outages sorted by (key, begin) and the number of eliminated outages.
+    """
+    rows = sorted(data, key=lambda row: (row[key], row["begin"]))
+    coalesced = []
+
+    for row in rows:
+        last = coalesced[-1] if coalesced else None
+
+        if last is not None and last[key] == row[key] and row["begin"] <= last["end"]:
+            if row["end"] > last["end"]:
+                last["end"] = row["end"]
+            continue
+
+        coalesced.append(dict(row))
+
+    return coalesced, len(rows) - len(coalesced)
+
+
+@traced()
+def create_interval_index(data: List[dict]) -> IntervalTree:
+    """
+    Build an interval index over the begin and end columns of outages.
+
+    Args:
+        data (List[dict]): Outages with begin and end fields, e.g. the result of `get_outages`.
+
+    Returns:
+        An IntervalTree whose items are (position in `data`, outage) tuples.
+    """
+    return IntervalTree(
+        [
+            (row["begin"], row["end"], (position, row))
+            for position, row in enumerate(data)
+        ]
+    )
+
+
+@traced()
+def filter_by_interval(
+    data: Union[List[dict], IntervalTree], begin: str, end: str = None
+) -> List[dict]:
+    """
+    Find the outages that overlap the window [begin, end], or that are active at `begin` if `end` is not given.
+
+    Args:
+        data (Union[List[dict], IntervalTree]): Outages or an index created by `create_interval_index`.
+            Creating the index once is worth it when there are more queries on the same outages.
+        begin (str): Start of the window in the outage timestamp format e.g. "2022-01-01T00:00:00.000Z"
+        end (str): End of the window.
+
+    Returns:
+        The outages that have begin <= window end and end >= window begin, in the order of the given outages.
+
+    Raises:
+        ValueError: If `end` is before `begin`.
+    """
+    if end is None:
+        end = begin
+
+    if end < begin:
+        raise ValueError("Window end must not be before window begin")
+
+    index = data if isinstance(data, IntervalTree) else create_interval_index(data)
+    found = sorted(index.overlap(begin, end), key=operator.itemgetter(0))
+    return [row for _, row in found]
+
+
+def is_sorted(df: pd.DataFrame, columns: list) -> bool:
+    """
+    Check if a df is sorted ascending by the given columns, without sorting it.
+
+    Numeric and datetime columns are compared as numpy arrays, the other columns(strings, or the NaN of an outer join
+    next to strings) by pandas. A df with missing values in the numeric columns is reported as not sorted,
+    so `sort_values` decides where they go.
+
+    Args:
+        df (pd.DataFrame): The df to check.
+        columns (List[str]): The sort columns, the first one is the most significant.
+
+    Returns:
+        True if the rows are in ascending order of the columns.
+    """
+    if len(df) < 2:
+        return True
+
+    if not all(
+        isinstance(df[column].dtype, np.dtype) and df[column].dtype.kind in "biufmM"
+        for column in columns
+    ):
+        return pd.MultiIndex.from_frame(df[columns]).is_monotonic_increasing
+
+    # the pairs of neighbour rows that are equal in all columns checked so far
+    undecided = np.ones(len(df) - 1, dtype=bool)
+
+    for column in columns:
+        values = df[column].to_numpy()
+        if values.dtype.kind in "fmM" and pd.isna(values).any():
+            return False
+
+        previous, following = values[:-1], values[1:]
+
+        if (undecided & (previous > following)).any():
+            return False
+
+        undecided &= previous == following
+        if not undecided.any():
+            break
+
+    return True
+
+
+def _merge_join(df1: pd.DataFrame, df2: pd.DataFrame, key: str) -> pd.DataFrame:
+    """
+    Inner join of df2 and df1 by walking both of them in key order.
+
+    The rows come out in the order of the sorted df1 rows, so if df1 is sorted by (key, ...) the result is too.
+    """
+    if not df1[key].is_monotonic_increasing:
+        df1 = df1.sort_values(by=key, kind="stable")
+    if not df2[key].is_monotonic_increasing:
+        df2 = df2.sort_values(by=key, kind="stable")
+
+    overlap = (set(df1.columns) & set(df2.columns)) - {key}
+    if overlap:
+        raise ValueError(f"columns overlap but no suffix specified: {sorted(overlap)}")
+
+    keys2 = df2[key].to_numpy()
+    keys1 = df1[key].to_numpy()
+
+    # matching df2 rows of each df1 row are the range [first, last) of the sorted df2 keys
+    first = np.searchsorted(keys2, keys1, side="left")
+    last = np.searchsorted(keys2, keys1, side="right")
+    counts = last - first
+
+    rows1 = np.repeat(np.arange(len(df1)), counts)
+    rows2 = np.repeat(first, counts) + (
+        np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+
+    final = pd.concat(
+        [
+            df2.iloc[rows2].reset_index(drop=True),
+            df1.drop(columns=key).iloc[rows1].reset_index(drop=True),
+        ],
+        axis=1,
+    )
+    return final
+
+
+@traced()
 def df_join(
     df1: pd.DataFrame,
     df2: pd.DataFrame,
     key: str,
     type: str,
     sort_columns: list,
+    strategy: str = "hash",
 ):
     """
     Joins two pandas dataframes on a specified key and returns the resulting dataframe.
@@ -268,25 +810,70 @@ def df_join(
         key (str): column for join
         type (str): The type of join to perform. Can be one of "inner", "outer", "left", or "right".
         sort_columns (List[str]): A list of column names to sort
+        strategy (str): How to join the dfs.
+            "hash": index both dfs by the key and join them.
+            "merge": sort-merge join, the inputs are sorted by the key only if they are not sorted yet and
+            the output keeps the order of df1, so there is nothing to sort when df1 is sorted by `sort_columns`.
+            Only "inner" joins are supported.
+            "auto": "merge" when df1 is already sorted by the key and the join is "inner", "hash" otherwise.
 
     Returns:
         joined pandas df
 
     Raises:
         TypeError: If `df1` or `df2` is not a df.
-        ValueError: If `key` is not a column in both df, or if `type` is not a valid join type.
+        ValueError: If `key` is not a column in both df, if `type` is not a valid join type or
+        `strategy` is not valid.
     """
-    df1 = df1.set_index(key)
-    df2 = df2.set_index(key)
-    final = df2.join(df1, how=type).reset_index()
-    sorted_final = final.sort_values(by=sort_columns)
-    return sorted_final
-
-
+    current_span().set_attribute("rows", (len(df1), len(df2)))
+
+    # ids of typed dfs(create_typed_dfs) are joined and sorted by their integer codes and turned back into ids after
+    id_dtype = None
+    if (
+        type == "inner"
+        and key in df1
+        and key in df2
+        and isinstance(df1[key].dtype, pd.CategoricalDtype)
+        and df1[key].dtype == df2[key].dtype
+        and df1[key].cat.categories.is_monotonic_increasing
+    ):
+        id_dtype = df1[key].dtype
+        df1 = df1.assign(**{key: df1[key].cat.codes})
+        df2 = df2.assign(**{key: df2[key].cat.codes})
+
+    if strategy == "auto":
+        merge = type == "inner" and key in df1 and df1[key].is_monotonic_increasing
+        strategy = "merge" if merge else "hash"
+
+    if strategy == "merge":
+        if type != "inner":
+            raise ValueError("merge strategy supports only inner join")
+        final = _merge_join(df1, df2, key)
+    elif strategy == "hash":
+        df1 = df1.set_index(key)
+        df2 = df2.set_index(key)
+        final = df2.join(df1, how=type).reset_index()
+    else:
+        raise ValueError(f"Unknown join strategy: {strategy}")
+
+    current_span().set_attribute("strategy", strategy)
+
+    if not is_sorted(final, sort_columns):
+        final = final.sort_values(by=sort_columns)
+
+    if id_dtype is not None:
+        final[key] = pd.Categorical.from_codes(final[key], dtype=id_dtype)
+
+    return final
+
+
+@traced()
 def df_to_json(data: pd.DataFrame) -> List[dict]:
     """
     Convert a pandas df to a list[dict]
 
+    Categorical columns are written as their values and datetime columns in the '2022-01-01T00:00:00.000Z' format.
+
     Args:
         data (pd.DataFrame): The DataFrame to be converted to JSON.
 
@@ -294,11 +881,96 @@ def df_to_json(data: pd.DataFrame) -> List[dict]:
         list of dict version of the given dataframe
 
     """
-    sorted_json = data.to_json(orient="records")
-    final_json = json.loads(sorted_json)
+    # naive datetime columns(create_typed_dfs) are in UTC, numpy writes them faster than to_json
+    stamp_columns = [
+        column
+        for column, dtype in data.dtypes.items()
+        if isinstance(dtype, np.dtype) and dtype.kind == "M"
+    ]
+    if stamp_columns:
+        data = data.copy(deep=False)
+        for column in stamp_columns:
+            stamps = data[column].to_numpy()
+            text = _iso_text(stamps).astype(object)
+            text[np.isnat(stamps)] = None
+            data[column] = text
+
+    sorted_json = data.to_json(orient="records", date_format="iso", date_unit="ms")
+    final_json = codec.loads(sorted_json)
     return final_json
 
 
+def select_site_outages(outages: list, site_info: dict, coalesce: bool = False) -> list:
+    """
+    Select the outages of a site: the outages since 2022-01-01 of the devices of the site.
+
+    Args:
+        outages (list): The outages, a list or anything `filter_by_column` accepts, e.g. an OutageSnapshot.
+        site_info (dict): The site info with its devices.
+        coalesce (bool): Merge the overlapping outages of each device.
+
+    Returns:
+        The outages of the site as a list of dicts.
+    """
+    filtered_data = filter_by_column(
+        data=outages,
+        column="begin",
+        value="2022-01-01T00:00:00.000Z",
+        op=">=",
+    )
+
+    filter_outages_id = filter_by_another_json(
+        site_info,
+        "devices",
+        "id",
+        filtered_data,
+    )
+
+    if coalesce:
+        filter_outages_id, eliminated = coalesce_outages(filter_outages_id)
+        logger.info(
+            "Overlapping outages coalesced",
+            extra={
+                "fields": {"site_id": site_info.get("id"), "eliminated": eliminated}
+            },
+        )
+
+    # a snapshot view is turned into rows only for the outages of the site
+    return list(filter_outages_id)
+
+
+def join_site_outages(site_outages: list, site_info: dict) -> list:
+    """
+    Add the device names to the outages of a site.
+
+    Args:
+        site_outages (list): The outages of the site, as returned by `select_site_outages`.
+        site_info (dict): The site info with its devices.
+
+    Returns:
+        The site outages with the device names, sorted by id and begin.
+    """
+    df_outages, df_site_devices = create_typed_dfs(site_outages, site_info["devices"])
+
+    final_site_outages_df = df_join(
+        df_outages,
+        df_site_devices,
+        "id",
+        "inner",
+        ["id", "begin"],
+        strategy="auto",
+    )
+
+    return df_to_json(final_site_outages_df)
+
+
+def build_site_outages(outages: list, site_info: dict, coalesce: bool = False) -> list:
+    """Select the outages of a site and add the device names, see `select_site_outages` and `join_site_outages`."""
+    site_outages = select_site_outages(outages, site_info, coalesce=coalesce)
+    return join_site_outages(site_outages, site_info)
+
+
+@traced()
 def post(
     endpoint: str = None,
     data: Union[list, dict] = None,
@@ -316,14 +988,16 @@ def post(
         headers (dict): The headers to be sent along with the request.
         max_retry (int): The max number of times to retry the request.
         wait_time_in_seconds (int):wait time between retries.
-        **kwargs: Any additional args.
+        **kwargs: Any additional args, `idempotency_key` is sent as the Idempotency-Key header(a new UUID if not given).
 
     Returns:
         requests.Response: The response from the API.
 
     Raises:
         ValueError: If the endpoint(siteid info) or data field is not provided.
-        Exception: If the request fails with a status code of 400, 403, 404 or all retry attempts are exhausted.
+        HTTPStatusError: If the request fails with a status code of 400, 403 or 404.
+        CircuitOpenError: If the endpoint keeps failing and its circuit breaker is open.
+        requests.RequestException: If the request times out or cannot connect.
     """
     if not endpoint:
         raise ValueError("Please provide an endpoint")
@@ -331,29 +1005,87 @@ def post(
     if not data:
         raise ValueError("data field cannot be empty")
 
+    attempt = kwargs.pop("attempt", 1)
+    # the retries send the same key, so the server can tell them from new posts(even of the same payload)
+    idempotency_key = kwargs.pop("idempotency_key", None) or str(uuid.uuid4())
     url = f"{_API}/{endpoint}"
+    current_span().set_attribute("endpoint", endpoint)
+    current_span().set_attribute("attempt", attempt)
+    body = codec.dumps(data)
 
+    breaker = get_breaker(endpoint)
+    breaker.before_request()
+
+    start = time.perf_counter()
+    response = None
     try:
-        response = requests.post(url=url, headers=headers, json=data)
+        response = _session.post(
+            url=url,
+            headers={
+                **headers,
+                "Content-Type": "application/json",
+                "Idempotency-Key": idempotency_key,
+            },
+            data=body,
+            timeout=_TIMEOUT_IN_SECONDS,
+        )
+        current_span().set_attribute("status", response.status_code)
+        _record_outcome(breaker, response)
         response.raise_for_status()
-        logging.basicConfig(level=logging.WARNING)
 
         if response.status_code == 200:
-            print(
-                f"The post request finished with status code {str(response.status_code)} successfully"
+            log_request(
+                "POST",
+                endpoint,
+                response.status_code,
+                time.perf_counter() - start,
+                attempt,
             )
             return response
 
     except:
+        latency = time.perf_counter() - start
+
+        if response is None:
+            breaker.record_failure()
+            log_request("POST", endpoint, None, latency, attempt)
+            raise
+
+        # 400, 403 and 404 will not change by trying again, even if retries are left
+        if response.status_code in (400, 403, 404):
+            mapping_status_code = {
+                400: "We cannot process your request because it doesn't match the required format.",
+                403: "You do not have the required permissions to make this request. Please set your api key as an env variable or check your Apikey is correct.",
+                404: "You have requested a resource that does not exist. Pls check your endpoint url.",
+            }
+
+            log_request("POST", endpoint, response.status_code, latency, attempt)
+            raise HTTPStatusError(
+                f"Error: Request failed with status code {response.status_code}, {mapping_status_code[response.status_code]}.",
+                response.status_code,
+            )
+
         if max_retry <= 0:
+            log_request(
+                "POST",
+                endpoint,
+                response.status_code,
+                latency,
+                attempt,
+                "Request failed, no retries left",
+            )
             return
 
         max_retry -= 1
 
         if response.status_code in (429, 500):
-            logger = logging.getLogger(f" Status code {response.status_code}")
-            logger.warning(
-                f"Request failed,The request will be send again after {wait_time_in_seconds}s. Remaining trial count is {max_retry}"
+            log_request(
+                "POST",
+                endpoint,
+                response.status_code,
+                latency,
+                attempt,
+                f"Request failed, it will be sent again after {wait_time_in_seconds}s. Remaining trial count is {max_retry}",
             )
 
             time.sleep(wait_time_in_seconds)
@@ -363,21 +1095,13 @@ def post(
                 headers=headers,
                 max_retry=max_retry,
                 wait_time_in_seconds=wait_time_in_seconds,
+                attempt=attempt + 1,
+                idempotency_key=idempotency_key,
                 **kwargs,
             )
 
-        if response.status_code in (400, 403, 404):
-            mapping_status_code = {
-                400: "We cannot process your request because it doesn't match the required format.",
-                403: "You do not have the required permissions to make this request. Please set your api key as an env variable or check your Apikey is correct.",
-                404: "You have requested a resource that does not exist. Pls check your endpoint url.",
-            }
-
-            raise Exception(
-                f"Error: Request failed with status code {response.status_code}, {mapping_status_code[response.status_code]}."
-            )
-
 
+@traced()
 def post_outages(site_id: str, data: dict, headers={}) -> List[dict]:
     """
     Send a POST request to create a new outage for a site specified by site_id.
@@ -388,7 +1112,8 @@ def post_outages(site_id: str, data: dict, headers={}) -> List[dict]:
     - headers (dict, optional): Any additional headers to be included in the request. Default is an empty dictionary.
 
     Returns:
-    - List[dict]: The response from the API as a list of dictionaries.
+    - List[dict]: The response from the API as a list of dictionaries. If a ledger is used(`use_ledger`) and the
+      same payload is the last one posted to the site, nothing is sent and SKIPPED is returned.
 
     Raises:
     - ValueError: If site_id or data are not provided.
@@ -412,6 +1137,113 @@ def post_outages(site_id: str, data: dict, headers={}) -> List[dict]:
     if not data:
         raise ValueError("Data must be given")
 
+    ledger = _ledger
+    # the same hash as the payload_fingerprint of the state file(run_delta)
+    payload_fingerprint = fingerprint(data)
+
+    if ledger is not None and ledger.is_posted(site_id, payload_fingerprint):
+        ledger.record_skip(len(codec.dumps(data)))
+        logger.info(
+            "Payload is already posted, post skipped",
+            extra={"fields": {"site_id": site_id}},
+        )
+        return SKIPPED
+
     r = post(endpoint=endpoint, data=data, headers=headers)
 
+    if r is not None and ledger is not None:
+        ledger.mark_posted(site_id, payload_fingerprint)
+
     return r
+
+
+def use_ledger(ledger) -> None:
+    """
+    Make `post_outages` skip the payloads that are already posted to the site.
+
+    Args:
+        ledger: A `ledger.PostLedger`, or None to post every payload again.
+    """
+    global _ledger
+    _ledger = ledger
+
+
+def fingerprint(data: Union[list, dict]) -> str:
+    """
+    Create a stable hash of a JSON-serializable object.
+
+    Args:
+        data (Union[list, dict]): The data to hash.
+
+    Returns:
+        The sha256 hex digest of the canonicalized (sorted keys, compact separators) JSON form of the data.
+    """
+    # stdlib json is used here instead of codec, so the fingerprints in a state file don't depend on the installed codec
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def load_state(path: str) -> dict:
+    """
+    Load the state of the previous runs from a JSON file.
+
+    Args:
+        path (str): Path of the state file.
+
+    Returns:
+        The state as a dict. If the file does not exist, an empty state `{"sites": {}}` is returned.
+    """
+    if not os.path.exists(path):
+        return {"sites": {}}
+
+    with open(path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+
+    state.setdefault("sites", {})
+    return state
+
+
+def save_state(state: dict, path: str) -> None:
+    """
+    Save the state of the run to a JSON file.
+
+    The file is written to a temporary file first and then replaced, so an interrupted run never leaves a broken state file.
+
+    Args:
+        state (dict): The state to save.
+        path (str): Path of the state file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+@traced()
+def diff_outages(
+    previous: List[dict], current: List[dict], key_columns: tuple = ("id", "begin")
+) -> dict:
+    """
+    Compare two outage lists and find the outages that are added, removed or changed.
+
+    Args:
+        previous (List[dict]): The outages of the previous run.
+        current (List[dict]): The outages of the current run.
+        key_columns (tuple): The columns that identify an outage.
+
+    Returns:
+        A dict with "added", "removed" and "changed" lists. "changed" contains the current version of the outages
+        whose key exists in both lists but whose other fields are different.
+    """
+    previous_by_key = {tuple(row[c] for c in key_columns): row for row in previous}
+    current_by_key = {tuple(row[c] for c in key_columns): row for row in current}
+
+    added = [row for k, row in current_by_key.items() if k not in previous_by_key]
+    removed = [row for k, row in previous_by_key.items() if k not in current_by_key]
+    changed = [
+        row
+        for k, row in current_by_key.items()
+        if k in previous_by_key and previous_by_key[k] != row
+    ]
+
+    return {"added": added, "removed": removed, "changed": changed}
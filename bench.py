@@ -0,0 +1,58 @@
+import json
+import time
+import uuid
+
+import click
+
+import codec
+from app import create_df, df_to_json
+
+
+def make_outages(rows: int, devices: int = 1000) -> list:
+    device_ids = [str(uuid.uuid4()) for _ in range(devices)]
+    return [
+        {
+            "id": device_ids[i % devices],
+            "begin": "2022-02-15T11:28:26.735Z",
+            "end": "2022-08-28T03:37:48.568Z",
+        }
+        for i in range(rows)
+    ]
+
+
+def measure(func, repeat: int) -> float:
+    """Return the best time of `repeat` calls of `func` in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@click.command()
+@click.option("--rows", default=500_000, help="Number of outages in the payload")
+@click.option("--repeat", default=5, help="Number of runs, the best one is reported")
+def cli(rows: int, repeat: int):
+    outages = make_outages(rows)
+    payload = json.dumps(outages).encode("utf-8")
+    size_mb = len(payload) / 1024 / 1024
+    df = create_df(outages)
+
+    print(f"codec: {codec.NAME}, payload: {rows} outages, {size_mb:.1f} MB")
+
+    cases = [
+        ("parse    json.loads(str)", lambda: json.loads(payload.decode("utf-8"))),
+        ("parse    codec.loads(bytes)", lambda: codec.loads(payload)),
+        ("serialize json.dumps", lambda: json.dumps(outages).encode("utf-8")),
+        ("serialize codec.dumps", lambda: codec.dumps(outages)),
+        ("df_to_json", lambda: df_to_json(df)),
+    ]
+
+    for name, func in cases:
+        seconds = measure(func, repeat)
+        print(f"{name:<30} {seconds * 1000:9.1f} ms {size_mb / seconds:9.1f} MB/s")
+
+
+if __name__ == "__main__":
+    cli()
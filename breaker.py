@@ -0,0 +1,165 @@
+import threading
+import time
+from typing import Dict
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit of its endpoint is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint that keeps failing, so the callers fail fast instead of waiting for the
+    retries of every request.
+
+    The circuit is closed at the beginning and every request is sent. After `failure_threshold` consecutive
+    failures(5xx responses, timeouts and connection errors) it opens and the requests are rejected with
+    CircuitOpenError. After `reset_timeout` seconds it is half-open, at most `half_open_max_calls` probe requests
+    are sent at the same time: a successful probe closes the circuit, a failed one opens it again.
+
+    Args:
+        failure_threshold (int): Number of consecutive failures that open the circuit.
+        reset_timeout (float): Seconds to wait in the open state before sending probes.
+        half_open_max_calls (int): Max number of probes at the same time in the half-open state.
+        clock (Callable): Returns the current time in seconds, `time.monotonic` by default.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        half_open_max_calls: int = 1,
+        clock=time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.clock = clock
+
+        self.trips = 0
+        self.rejected = 0
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def before_request(self) -> None:
+        """
+        Call before sending a request.
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with all probes in flight.
+        """
+        with self._lock:
+            state = self._current_state()
+
+            if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+
+            if state != CLOSED:
+                self.rejected += 1
+                raise CircuitOpenError(
+                    f"Circuit is {state} after {self.failure_threshold} failures in a row, request not sent"
+                )
+
+    def record_success(self) -> None:
+        """Call when the server answered, even with a 4xx status code."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        """Call when the server answered with a 5xx status code or didn't answer."""
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._state = OPEN
+                self._opened_at = self.clock()
+                self._failures = 0
+                self.trips += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._current_state(),
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "consecutive_failures": self._failures,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_settings = {"failure_threshold": 5, "reset_timeout": 30.0, "half_open_max_calls": 1}
+
+
+def configure(**settings) -> None:
+    """
+    Change the settings of the circuit breakers and forget the current breakers.
+
+    Args:
+        **settings: `failure_threshold`, `reset_timeout` or `half_open_max_calls`, see CircuitBreaker.
+    """
+    with _breakers_lock:
+        _settings.update(settings)
+        _breakers.clear()
+
+
+def reset() -> None:
+    """Forget the current breakers, so every endpoint starts closed."""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """
+    Get the breaker of an endpoint.
+
+    The endpoints with the same first path segment share a breaker, e.g. the site info of every site, so a degraded
+    endpoint is detected across the sites of a batch.
+
+    Args:
+        endpoint (str): The endpoint of the request, like "site-info/norwich-pear-tree".
+
+    Returns:
+        The breaker, created on the first use.
+    """
+    name = endpoint.split("/", 1)[0]
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(**_settings)
+        return breaker
+
+
+def get_breaker_stats() -> Dict[str, dict]:
+    """
+    Get the state and the counters of the breakers.
+
+    Returns:
+        CircuitBreaker.stats of each breaker by the name of its endpoint.
+    """
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: breaker.stats for name, breaker in breakers.items()}
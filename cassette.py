@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+import zipfile
+from collections import defaultdict, deque
+from datetime import timedelta
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import app
+
+# Layout of a cassette (a zip file, every member deflated):
+#   exchanges.json : list of {"method", "url", "status", "reason", "headers", "elapsed", "request_body", "body"}
+#                    in the order the responses are received, "body" is the member holding the response body and
+#                    "request_body" the member holding the request body(None for a request without a body)
+#   bodies/<n>     : response bodies
+#   bodies/<n>.req : request bodies
+_INDEX = "exchanges.json"
+
+
+class CassetteMiss(requests.ConnectionError):
+    """Raised in replay mode for a request that is not in the cassette, or asked more times than it was recorded."""
+
+
+def install(adapter: BaseAdapter, session: requests.Session = None) -> BaseAdapter:
+    """
+    Send the API requests of the session(the session of `app` by default) through the adapter.
+
+    Args:
+        adapter (BaseAdapter): A RecordingAdapter or a ReplayAdapter.
+        session (requests.Session): The session to use the adapter in.
+
+    Returns:
+        The adapter.
+    """
+    (session or app._session).mount(app._API, adapter)
+    return adapter
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Sends the requests with another adapter and writes every exchange into a cassette.
+
+    The method, the URL and the body of each request are kept, but not its headers, so the API key is not written.
+    `save` must be called when the run is finished.
+
+    Args:
+        path (str): Path of the cassette.
+        inner (BaseAdapter): Adapter that sends the requests, a HTTPAdapter by default.
+    """
+
+    def __init__(self, path: str, inner: BaseAdapter = None):
+        super().__init__()
+        self.path = path
+        self.inner = inner or HTTPAdapter()
+        self.exchanges = []
+        self._lock = threading.Lock()
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def send(self, request, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        response = self.inner.send(request, **kwargs)
+        # reading the content here keeps the elapsed time comparable to a non-streamed request
+        content = response.content
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            body = f"bodies/{len(self.exchanges)}"
+            self._zip.writestr(body, content)
+
+            request_body = None
+            if request.body:
+                request_body = f"{body}.req"
+                data = request.body
+                self._zip.writestr(
+                    request_body,
+                    data.encode("utf-8") if isinstance(data, str) else data,
+                )
+
+            self.exchanges.append(
+                {
+                    "method": request.method,
+                    "url": request.url,
+                    "status": response.status_code,
+                    "reason": response.reason,
+                    "headers": dict(response.headers),
+                    "elapsed": elapsed,
+                    "request_body": request_body,
+                    "body": body,
+                }
+            )
+
+        return response
+
+    def save(self) -> None:
+        """Write the index of the exchanges and close the cassette."""
+        with self._lock:
+            if self._zip is None:
+                return
+            self._zip.writestr(_INDEX, json.dumps(self.exchanges))
+            self._zip.close()
+            self._zip = None
+
+    def close(self):
+        self.inner.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers the requests with the responses of a cassette instead of sending them.
+
+    The exchanges are matched by method and URL(with the query string), the bodies of the requests are not compared,
+    so a changed transform still gets the recorded answers of its posts. A request sent more than once(retries,
+    repeated polls) gets the recorded responses in the recorded order.
+
+    Args:
+        path (str): Path of the cassette.
+        latency (str): "original" to wait as long as the recorded request took, "zero" to answer immediately.
+    """
+
+    def __init__(self, path: str, latency: str = "original"):
+        super().__init__()
+        if latency not in ("original", "zero"):
+            raise ValueError("latency must be 'original' or 'zero'")
+
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._exchanges = defaultdict(deque)
+
+        with zipfile.ZipFile(path) as archive:
+            for exchange in json.loads(archive.read(_INDEX)):
+                exchange["content"] = archive.read(exchange["body"])
+                key = (exchange["method"], exchange["url"])
+                self._exchanges[key].append(exchange)
+
+    def send(self, request, **kwargs) -> requests.Response:
+        with self._lock:
+            queue = self._exchanges.get((request.method, request.url))
+            if not queue:
+                raise CassetteMiss(
+                    f"{request.method} {request.url} is not in the cassette",
+                    request=request,
+                )
+            exchange = queue.popleft()
+
+        if self.latency == "original":
+            time.sleep(exchange["elapsed"])
+
+        response = requests.Response()
+        response.status_code = exchange["status"]
+        response.reason = exchange["reason"]
+        response.headers = CaseInsensitiveDict(exchange["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = exchange["content"]
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=exchange["elapsed"])
+        return response
+
+    def close(self):
+        pass
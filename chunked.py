@@ -0,0 +1,133 @@
+import heapq
+import itertools
+import os
+import sys
+import tempfile
+from typing import Iterable, Iterator, List
+
+import codec
+from app import select_site_outages, join_site_outages
+
+# max number of spilled partitions merged at the same time, each of them keeps a file open while it is read
+_MAX_MERGE_FILES = 64
+
+
+def _sort_key(row: dict) -> tuple:
+    return row["id"], row["begin"]
+
+
+def _row_bytes(row: dict) -> int:
+    """Estimate the memory of one outage while it is joined: the dict, its strings and the df/JSON copies of it."""
+    size = sys.getsizeof(row) + sum(
+        sys.getsizeof(key) + sys.getsizeof(value) for key, value in row.items()
+    )
+    return size * 4
+
+
+def _chunks(outages, size: int) -> Iterator[List[dict]]:
+    if hasattr(outages, "iter_chunks"):
+        yield from outages.iter_chunks(size)
+        return
+
+    rows = iter(outages)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _spill(rows: Iterable[dict], path: str) -> str:
+    with open(path, "wb") as f:
+        for row in rows:
+            f.write(codec.dumps(row))
+            f.write(b"\n")
+    return path
+
+
+def _read_spilled(path: str) -> Iterator[dict]:
+    with open(path, "rb") as f:
+        for line in f:
+            yield codec.loads(line)
+
+
+def _merge_spilled(paths: List[str], tmp_dir: str) -> List[str]:
+    """
+    Merge neighbouring spilled partitions into bigger ones, in passes, until at most `_MAX_MERGE_FILES` are left.
+
+    Only neighbours are merged together, so the partition order of equal keys is kept.
+    """
+    number = 0
+    while len(paths) > _MAX_MERGE_FILES:
+        merged = []
+        for i in range(0, len(paths), _MAX_MERGE_FILES):
+            group = paths[i : i + _MAX_MERGE_FILES]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+
+            rows = heapq.merge(*map(_read_spilled, group), key=_sort_key)
+            merged.append(_spill(rows, os.path.join(tmp_dir, f"merged-{number}.jsonl")))
+            number += 1
+            for path in group:
+                os.remove(path)
+
+        paths = merged
+
+    return paths
+
+
+def build_site_outages_chunked(
+    outages: List[dict], site_info: dict, memory_budget: int
+) -> List[dict]:
+    """
+    Build the site outages like `app.build_site_outages`, processing the outages in chunks under a memory budget.
+
+    The outages are filtered and joined chunk by chunk, each chunk gives a partition sorted by (id, begin).
+    Partitions are kept in memory while they fit into the budget, the rest is spilled to temporary files.
+    At the end all partitions are k-way merged by (id, begin), the spilled ones are first merged into at most
+    `_MAX_MERGE_FILES` files so the number of open files stays bounded.
+
+    Args:
+        outages (List[dict]): The outages, a list or an OutageSnapshot which is read chunk by chunk from its file.
+        site_info (dict): The site info.
+        memory_budget (int): Memory budget in bytes for the chunks and the partitions kept in memory.
+
+    Returns:
+        The site outages sorted by (id, begin).
+    """
+    first = next(iter(_chunks(outages, 1)), None)
+    if not first:
+        return []
+
+    # half of the budget for the chunk being joined, the other half for the partitions kept in memory
+    row_bytes = _row_bytes(first[0])
+    chunk_size = max(1, memory_budget // 2 // row_bytes)
+    kept_rows_limit = max(1, memory_budget // 2 // row_bytes)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        partitions = []
+        spilled = []
+        kept_rows = 0
+
+        for number, chunk in enumerate(_chunks(outages, chunk_size)):
+            site_outages = select_site_outages(chunk, site_info)
+            if not site_outages:
+                continue
+
+            partition = join_site_outages(site_outages, site_info)
+
+            # once a partition is spilled the next ones are spilled too, so the spilled partitions are neighbours
+            if not spilled and kept_rows + len(partition) <= kept_rows_limit:
+                partitions.append(partition)
+                kept_rows += len(partition)
+            else:
+                path = os.path.join(tmp_dir, f"partition-{number}.jsonl")
+                spilled.append(_spill(partition, path))
+
+        for path in _merge_spilled(spilled, tmp_dir):
+            partitions.append(_read_spilled(path))
+
+        # heapq.merge keeps the partition order for equal keys, like the chunks are in the outages
+        merged = heapq.merge(*partitions, key=_sort_key)
+        return list(merged)
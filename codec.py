@@ -0,0 +1,46 @@
+import json
+from typing import Any, Union
+
+# orjson is optional, it is used when it is installed because it is several times faster than json.
+# orjson.JSONDecodeError is a subclass of json.JSONDecodeError, so the errors are the same for both.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NAME = "orjson" if orjson else "json"
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Parse JSON from bytes or a string.
+
+    Args:
+        data (Union[bytes, str]): The JSON document. Bytes are parsed directly without decoding them to a string first.
+
+    Returns:
+        The parsed object.
+
+    Raises:
+        json.JSONDecodeError: If the data is not valid JSON.
+    """
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def dumps(data: Any) -> bytes:
+    """
+    Serialize an object to compact UTF-8 JSON bytes.
+
+    Args:
+        data (Any): The object to serialize.
+
+    Returns:
+        The JSON document as bytes.
+    """
+    if orjson:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
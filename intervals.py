@@ -0,0 +1,109 @@
+from typing import Any, List, Tuple
+
+
+class _Node:
+    __slots__ = ("center", "by_begin", "by_end", "left", "right")
+
+    def __init__(self, center, by_begin, by_end, left, right):
+        self.center = center
+        self.by_begin = by_begin
+        self.by_end = by_end
+        self.left = left
+        self.right = right
+
+
+class IntervalTree:
+    """
+    Static centered interval tree over closed intervals [begin, end].
+
+    Each node keeps the intervals that contain its center twice, sorted by begin and by end(descending),
+    intervals that end before the center go to the left subtree and the ones that begin after it to the right.
+    Every node holds at least one interval and the subtrees are at most half of the node, so the point and
+    overlap queries run in O(log n + k) where k is the number of found intervals.
+
+    Args:
+        intervals (List[Tuple[Any, Any, Any]]): (begin, end, item) tuples. begin and end can be any comparable
+        values, e.g. ISO timestamps of the same format.
+    """
+
+    def __init__(self, intervals: List[Tuple[Any, Any, Any]]):
+        self.size = len(intervals)
+        self.root = self._build(list(intervals))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _build(self, intervals: list) -> _Node:
+        if not intervals:
+            return None
+
+        begins = sorted(interval[0] for interval in intervals)
+        center = begins[len(begins) // 2]
+
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        return _Node(
+            center,
+            sorted(here, key=lambda interval: interval[0]),
+            sorted(here, key=lambda interval: interval[1], reverse=True),
+            self._build(left),
+            self._build(right),
+        )
+
+    def overlap(self, begin: Any, end: Any) -> list:
+        """
+        Find the intervals that overlap [begin, end].
+
+        Args:
+            begin (Any): Start of the window.
+            end (Any): End of the window.
+
+        Returns:
+            The items of the intervals having interval begin <= end and interval end >= begin.
+        """
+        found = []
+        nodes = [self.root]
+
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+
+            if end < node.center:
+                # every interval of the node ends after the window begins, check only where they begin
+                for interval in node.by_begin:
+                    if interval[0] > end:
+                        break
+                    found.append(interval[2])
+                nodes.append(node.left)
+            elif begin > node.center:
+                for interval in node.by_end:
+                    if interval[1] < begin:
+                        break
+                    found.append(interval[2])
+                nodes.append(node.right)
+            else:
+                found.extend(interval[2] for interval in node.by_begin)
+                nodes.append(node.left)
+                nodes.append(node.right)
+
+        return found
+
+    def stab(self, point: Any) -> list:
+        """
+        Find the intervals that contain a point.
+
+        Args:
+            point (Any): The point to check.
+
+        Returns:
+            The items of the intervals having begin <= point <= end.
+        """
+        return self.overlap(point, point)
@@ -0,0 +1,63 @@
+import threading
+
+from app import load_state, save_state
+
+
+class PostLedger:
+    """
+    Remembers the fingerprint of the last payload posted to each site, so the same payload is not posted again.
+
+    The ledger file has the format of the state file(`load_state`), the fingerprint of a site is its
+    "payload_fingerprint", so a state file written by `run_delta` can be used as a ledger and the other way round.
+    Give the ledger to `app.use_ledger` to make `post_outages` skip the payloads already posted.
+
+    Args:
+        path (str): Path of the ledger file, it is created by `save` if it doesn't exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fingerprints = {
+            site_id: site_state.get("payload_fingerprint")
+            for site_id, site_state in load_state(path)["sites"].items()
+        }
+        self.requests_saved = 0
+        self.bytes_saved = 0
+        self._posted = {}
+        self._lock = threading.Lock()
+
+    def is_posted(self, site_id: str, payload_fingerprint: str) -> bool:
+        """Return True if the last payload posted to the site has the fingerprint."""
+        with self._lock:
+            return self.fingerprints.get(site_id) == payload_fingerprint
+
+    def mark_posted(self, site_id: str, payload_fingerprint: str) -> None:
+        """Record the fingerprint of a payload posted to the site."""
+        with self._lock:
+            self.fingerprints[site_id] = payload_fingerprint
+            self._posted[site_id] = payload_fingerprint
+
+    def record_skip(self, size: int) -> None:
+        """Count a skipped POST and the size of its body."""
+        with self._lock:
+            self.requests_saved += 1
+            self.bytes_saved += size
+
+    @property
+    def stats(self) -> dict:
+        return {"requests_saved": self.requests_saved, "bytes_saved": self.bytes_saved}
+
+    def save(self) -> None:
+        """
+        Write the fingerprints of the payloads posted in this run to the ledger file.
+
+        The file is read again and only the "payload_fingerprint" of the posted sites is changed, so the other
+        fields of a state file(and the changes `run_delta` saved in the meantime) are kept.
+        """
+        with self._lock:
+            state = load_state(self.path)
+            for site_id, payload_fingerprint in self._posted.items():
+                state["sites"].setdefault(site_id, {})[
+                    "payload_fingerprint"
+                ] = payload_fingerprint
+            save_state(state, self.path)
@@ -0,0 +1,135 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+logger = logging.getLogger("krakenflex")
+
+_listener = None
+_success_sample_rate = 1.0
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Format a record as `time level message key=value ...` with the structured fields of the record."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"{self.formatTime(record)} {record.levelname} {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+def configure_logging(
+    level: int = logging.INFO, success_sample_rate: float = 0.1, stream=None
+) -> None:
+    """
+    Send the logs of the app through a queue to a background thread which writes them to the stream.
+
+    The requests only put the records into the queue, so a slow console doesn't slow them down.
+
+    Args:
+        level (int): The minimum level to log.
+        success_sample_rate (float): Share of the successful request events to log, between 0 and 1.
+            Failures and retries are always logged.
+        stream: Where to write the logs, stderr by default.
+    """
+    global _listener, _success_sample_rate
+
+    stop_logging()
+
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(KeyValueFormatter())
+
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _success_sample_rate = success_sample_rate
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+
+def configure_worker_logging(level: int = logging.INFO, stream=None) -> None:
+    """
+    Write the logs of a worker process directly to the stream.
+
+    A worker process doesn't run the background thread of its parent, and its pool can end it without flushing a
+    queue, so its records are written without one.
+
+    Args:
+        level (int): The minimum level to log.
+        stream: Where to write the logs, stderr by default.
+    """
+    global _listener
+
+    # a forked worker has a copy of the parent's listener, but not its thread
+    _listener = None
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(KeyValueFormatter())
+
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def stop_logging() -> None:
+    """Write the queued records and stop the background thread."""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_request(
+    method: str,
+    endpoint: str,
+    status: int,
+    latency: float,
+    attempt: int,
+    message: str = None,
+) -> None:
+    """
+    Log a request with its structured fields.
+
+    Successful requests are logged at INFO level and sampled, the others at WARNING level. The records go to the
+    handlers already set on the logger(`configure_logging` in the CLI, `configure_worker_logging` in a worker),
+    logging is not configured here.
+
+    Args:
+        method (str): HTTP method.
+        endpoint (str): The endpoint of the request.
+        status (int): The response status code, None if there is no response.
+        latency (float): Duration of the request in seconds.
+        attempt (int): 1 for the first try, 2 for the first retry...
+        message (str): Optional message, e.g. the retry plan.
+    """
+    success = status is not None and status < 400
+
+    if success:
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        if _success_sample_rate < 1 and random.random() >= _success_sample_rate:
+            return
+
+    fields = {
+        "method": method,
+        "endpoint": endpoint,
+        "status": status,
+        "latency_ms": round(latency * 1000, 1),
+        "attempt": attempt,
+    }
+
+    logger.log(
+        logging.INFO if success else logging.WARNING,
+        message or ("Request finished" if success else "Request failed"),
+        extra={"fields": fields},
+    )
+
+
+atexit.register(stop_logging)
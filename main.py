@@ -4,59 +4,487 @@ from app import (
     get_x_api_key,
     get_outages,
     get_site_info,
-    filter_by_column,
-    filter_by_another_json,
-    create_df,
-    df_join,
-    df_to_json,
     post_outages,
+    select_site_outages,
+    join_site_outages,
+    build_site_outages,
+    use_ledger,
+    fingerprint,
+    load_state,
+    save_state,
+    diff_outages,
+    filter_by_interval,
 )
+from snapshot import open_snapshot, write_snapshot
+from parallel import build_sites_parallel
+from pipeline import run_pipeline
+from chunked import build_site_outages_chunked
+from watch import Watcher
+from cassette import RecordingAdapter, ReplayAdapter, install
+from ledger import PostLedger
+from log import logger, configure_logging
+import tracing
+import breaker
+from tracing import traced
 
 
-def run(site_id: str):
+def run_delta(
+    site_id: str,
+    outages: list,
+    site_info: dict,
+    state: dict,
+    headers: dict,
+    coalesce: bool = False,
+):
+    """
+    Post the site outages only if they changed since the last run which is recorded in `state`.
+
+    The state keeps for each site the fingerprint of the site's outage snapshot (filtered outages and devices),
+    the fingerprint of the posted payload and the posted payload itself. If the snapshot is the same,
+    the join and the POST are skipped. Otherwise the payload is compared with the last posted one.
+    """
+    site_state = state["sites"].get(site_id, {})
+
+    site_outages = select_site_outages(outages, site_info, coalesce=coalesce)
+    snapshot_fingerprint = fingerprint([site_outages, site_info["devices"]])
+
+    if site_state.get("snapshot_fingerprint") == snapshot_fingerprint:
+        logger.info(
+            "No outage changes, post skipped", extra={"fields": {"site_id": site_id}}
+        )
+        return
+
+    data = join_site_outages(site_outages, site_info)
+    payload_fingerprint = fingerprint(data)
+    delta = diff_outages(site_state.get("payload", []), data)
+
+    logger.info(
+        "Site outages changed",
+        extra={
+            "fields": {
+                "site_id": site_id,
+                "added": len(delta["added"]),
+                "removed": len(delta["removed"]),
+                "changed": len(delta["changed"]),
+            }
+        },
+    )
+
+    if site_state.get("payload_fingerprint") != payload_fingerprint:
+        r = post_outages(site_id=site_id, data=data, headers=headers)
+        if r is None:
+            # post failed, keep the old state so the next run tries again
+            return
+    else:
+        logger.info(
+            "Payload is not changed, post skipped",
+            extra={"fields": {"site_id": site_id}},
+        )
+
+    state["sites"][site_id] = {
+        "snapshot_fingerprint": snapshot_fingerprint,
+        "payload_fingerprint": payload_fingerprint,
+        "payload": data,
+    }
+
+
+def load_outages(
+    headers: dict,
+    load_snapshot: str = None,
+    save_snapshot: str = None,
+    window: tuple = None,
+    page_size: int = None,
+):
+    if load_snapshot:
+        outages = open_snapshot(load_snapshot)
+    else:
+        outages = get_outages(headers=headers, page_size=page_size)
+
+    if save_snapshot:
+        write_snapshot(outages, save_snapshot)
+
+    if window:
+        outages = filter_by_interval(outages, *window)
+
+    return outages
+
+
+@traced()
+def run(
+    site_id: str,
+    state_file: str = None,
+    load_snapshot: str = None,
+    save_snapshot: str = None,
+    window: tuple = None,
+    coalesce: bool = False,
+    memory_budget: int = None,
+    page_size: int = None,
+):
     x_api_key = get_x_api_key()
     headers = {"X-API-Key": x_api_key}
 
-    outages = get_outages(headers=headers)
+    outages = load_outages(headers, load_snapshot, save_snapshot, window, page_size)
 
     site_info = get_site_info(site_id=site_id, headers=headers)
 
-    filtered_data = filter_by_column(
-        data=outages,
-        column="begin",
-        value="2022-01-01T00:00:00.000Z",
-        op=">=",
-    )
+    if state_file:
+        state = load_state(state_file)
+        run_delta(site_id, outages, site_info, state, headers, coalesce=coalesce)
+        save_state(state, state_file)
+        return
 
-    filter_outages_id = filter_by_another_json(
-        site_info,
-        "devices",
-        "id",
-        filtered_data,
+    if memory_budget:
+        data = build_site_outages_chunked(outages, site_info, memory_budget)
+    else:
+        data = build_site_outages(outages, site_info, coalesce=coalesce)
+
+    logger.info(
+        "Posting site outages",
+        extra={"fields": {"site_id": site_id, "outages": len(data)}},
     )
 
-    df_outages = create_df(filter_outages_id)
-    df_site_devices = create_df(site_info["devices"])
+    post_outages(site_id=site_id, data=data, headers=headers)
+
+
+def run_many(
+    site_ids: list,
+    workers: int = None,
+    load_snapshot: str = None,
+    save_snapshot: str = None,
+    window: tuple = None,
+    coalesce: bool = False,
+    page_size: int = None,
+):
+    """
+    Post the site outages of many sites, building them in a process pool.
+
+    The outages and the site infos are fetched once in this process, the outages are shared with the workers through
+    shared memory(or the snapshot file), the workers only run the filters and the join,
+    and the results are posted from this process as they come back. A failing site(its site info, its join or its
+    post) is logged and the other sites are still posted.
+
+    Returns:
+        The errors by site id.
+    """
+    x_api_key = get_x_api_key()
+    headers = {"X-API-Key": x_api_key}
+
+    outages = load_outages(headers, load_snapshot, save_snapshot, window, page_size)
+
+    errors = {}
+    site_infos = {}
+    for site_id in site_ids:
+        try:
+            site_infos[site_id] = get_site_info(site_id=site_id, headers=headers)
+        except Exception as e:
+            errors[site_id] = e
+            logger.warning(
+                "Site failed", extra={"fields": {"site_id": site_id, "error": e}}
+            )
+
+    # the workers can map the given snapshot file directly if the outages are not filtered by a window
+    snapshot_path = load_snapshot if load_snapshot and not window else None
+
+    for site_id, data, error in build_sites_parallel(
+        outages,
+        site_infos,
+        workers=workers,
+        coalesce=coalesce,
+        snapshot_path=snapshot_path,
+    ):
+        if error is None:
+            try:
+                if post_outages(site_id=site_id, data=data, headers=headers) is None:
+                    error = Exception(f"Post of site {site_id} failed")
+            except Exception as e:
+                error = e
+
+        if error is not None:
+            errors[site_id] = error
+            logger.warning(
+                "Site failed", extra={"fields": {"site_id": site_id, "error": error}}
+            )
+
+    return errors
+
+
+def run_pipelined(
+    site_ids: list,
+    load_snapshot: str = None,
+    save_snapshot: str = None,
+    window: tuple = None,
+    coalesce: bool = False,
+    page_size: int = None,
+):
+    """
+    Post the site outages of many sites, overlapping the site info fetches, the joins and the posts of different sites.
+    """
+    x_api_key = get_x_api_key()
+    headers = {"X-API-Key": x_api_key}
+
+    outages = load_outages(headers, load_snapshot, save_snapshot, window, page_size)
+    stats = run_pipeline(site_ids, outages, headers, coalesce=coalesce)
 
-    final_site_outages_df = df_join(
-        df_outages,
-        df_site_devices,
-        "id",
-        "inner",
-        ["id", "begin"],
+    for stage in ("fetch", "transform", "upload"):
+        logger.info(
+            "Pipeline stage finished",
+            extra={
+                "fields": {
+                    "stage": stage,
+                    "sites": stats[stage]["processed"],
+                    "utilization": round(stats[stage]["utilization"], 2),
+                }
+            },
+        )
+    for site_id, error in stats["errors"].items():
+        logger.warning(
+            "Site failed", extra={"fields": {"site_id": site_id, "error": error}}
+        )
+
+
+def log_breaker_stats():
+    for endpoint, stats in breaker.get_breaker_stats().items():
+        if stats["trips"]:
+            logger.warning(
+                "Circuit breaker tripped",
+                extra={"fields": {"endpoint": endpoint, **stats}},
+            )
+
+
+@click.group(invoke_without_command=True)
+@click.option(
+    "--site-id",
+    "site_ids",
+    multiple=True,
+    default=["norwich-pear-tree"],
+    help="Site id of site info, can be given more than once",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of processes to build the site outages of many sites, the number of CPUs by default",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    default=False,
+    help="Overlap the site info fetches, joins and posts of many sites on thread pools instead of using processes",
+)
+@click.option(
+    "--state-file",
+    default=None,
+    help="Path of the state file, if given only changed site outages are posted",
+)
+@click.option(
+    "--load-snapshot",
+    default=None,
+    help="Read the outages from a snapshot file instead of the API",
+)
+@click.option(
+    "--save-snapshot", default=None, help="Save the outages to a snapshot file"
+)
+@click.option(
+    "--window",
+    nargs=2,
+    default=None,
+    help="Only post the outages overlapping the window BEGIN END, give the same time twice for the outages active at that time",
+)
+@click.option(
+    "--coalesce",
+    is_flag=True,
+    default=False,
+    help="Merge the overlapping outages of each device before the join",
+)
+@click.option(
+    "--memory-budget",
+    type=int,
+    default=None,
+    help="Process the outages in chunks using at most this many MB, spilling to temporary files when needed",
+)
+@click.option(
+    "--page-size",
+    type=int,
+    default=None,
+    help="Fetch the outages in pages of this size, several pages at the same time",
+)
+@click.option(
+    "--log-sample-rate",
+    type=float,
+    default=0.1,
+    help="Share of the successful requests to log, failed requests are always logged",
+)
+@click.option(
+    "--trace",
+    "trace_path",
+    default=None,
+    help="Record the spans of the run and write them to this file",
+)
+@click.option(
+    "--trace-format",
+    type=click.Choice(["chrome", "jsonl"]),
+    default="chrome",
+    help="Format of the trace file, Chrome trace events or JSON lines",
+)
+@click.option(
+    "--breaker-failures",
+    type=int,
+    default=5,
+    help="Number of failures in a row(5xx or timeouts) that stop the requests to an endpoint for a while",
+)
+@click.option(
+    "--breaker-reset-timeout",
+    type=float,
+    default=30.0,
+    help="Seconds to wait before a probe request is sent to an endpoint that is stopped",
+)
+@click.option(
+    "--ledger",
+    "ledger_path",
+    default=None,
+    help="Keep the hashes of the posted payloads in this file and skip posting the same payload to a site again",
+)
+@click.option(
+    "--record",
+    "record_path",
+    default=None,
+    help="Write every request and response of the run to this cassette file",
+)
+@click.option(
+    "--replay",
+    "replay_path",
+    default=None,
+    help="Answer the requests from this cassette file instead of the API",
+)
+@click.option(
+    "--replay-latency",
+    type=click.Choice(["original", "zero"]),
+    default="original",
+    help="Wait as long as the recorded requests took, or answer them immediately",
+)
+@click.pass_context
+def cli(
+    ctx,
+    site_ids: tuple,
+    workers: int,
+    pipeline: bool,
+    state_file: str,
+    load_snapshot: str,
+    save_snapshot: str,
+    window: tuple,
+    coalesce: bool,
+    memory_budget: int,
+    page_size: int,
+    log_sample_rate: float,
+    trace_path: str,
+    trace_format: str,
+    record_path: str,
+    replay_path: str,
+    replay_latency: str,
+    ledger_path: str,
+    breaker_failures: int,
+    breaker_reset_timeout: float,
+):
+    configure_logging(success_sample_rate=log_sample_rate)
+
+    breaker.configure(
+        failure_threshold=breaker_failures, reset_timeout=breaker_reset_timeout
     )
+    ctx.call_on_close(log_breaker_stats)
 
-    data = df_to_json(final_site_outages_df)
+    if record_path and replay_path:
+        raise click.UsageError("--record and --replay cannot be used together")
 
-    print(f"Posted data: {data}")
+    if record_path:
+        recorder = install(RecordingAdapter(record_path))
+        ctx.call_on_close(recorder.save)
 
-    post_outages(site_id=site_id, data=data, headers=headers)
+    if replay_path:
+        install(ReplayAdapter(replay_path, latency=replay_latency))
+
+    if ledger_path:
+        ledger = PostLedger(ledger_path)
+        use_ledger(ledger)
+
+        def close_ledger():
+            ledger.save()
+            logger.info("Post ledger saved", extra={"fields": ledger.stats})
 
+        ctx.call_on_close(close_ledger)
 
-@click.command()
-@click.option("--site-id", default="norwich-pear-tree", help="Site id of site info")
-def cli(site_id: str):
-    run(site_id=site_id)
+    if trace_path:
+        tracing.enable()
+        export = (
+            tracing.export_chrome_trace
+            if trace_format == "chrome"
+            else tracing.export_json_lines
+        )
+        # runs after the command or the subcommand is finished
+        ctx.call_on_close(lambda: export(trace_path))
+
+    if ctx.invoked_subcommand is not None:
+        return
+
+    if memory_budget and (
+        coalesce or state_file or len(site_ids) > 1 or workers or pipeline
+    ):
+        raise click.UsageError(
+            "--memory-budget can be used with one site only and without --coalesce or --state-file"
+        )
+
+    if state_file and (len(site_ids) > 1 or workers or pipeline):
+        raise click.UsageError("--state-file can be used with one site only")
+
+    if pipeline:
+        run_pipelined(
+            site_ids=list(site_ids),
+            load_snapshot=load_snapshot,
+            save_snapshot=save_snapshot,
+            window=window,
+            coalesce=coalesce,
+            page_size=page_size,
+        )
+    elif len(site_ids) > 1 or workers:
+        run_many(
+            site_ids=list(site_ids),
+            workers=workers,
+            load_snapshot=load_snapshot,
+            save_snapshot=save_snapshot,
+            window=window,
+            coalesce=coalesce,
+            page_size=page_size,
+        )
+    else:
+        run(
+            site_id=site_ids[0],
+            state_file=state_file,
+            load_snapshot=load_snapshot,
+            save_snapshot=save_snapshot,
+            window=window,
+            coalesce=coalesce,
+            memory_budget=memory_budget * 1024 * 1024 if memory_budget else None,
+            page_size=page_size,
+        )
+
+
+@cli.command()
+@click.option(
+    "--site-id",
+    "site_ids",
+    multiple=True,
+    default=["norwich-pear-tree"],
+    help="Site id to watch, can be given more than once",
+)
+@click.option("--interval", default=60.0, help="Seconds between two outage polls")
+@click.option(
+    "--site-info-ttl", default=3600.0, help="Seconds to keep a site info in memory"
+)
+def watch(site_ids: tuple, interval: float, site_info_ttl: float):
+    """Keep running and post the outages of the sites whenever they change."""
+    headers = {"X-API-Key": get_x_api_key()}
+    Watcher(
+        list(site_ids), headers, interval=interval, site_info_ttl=site_info_ttl
+    ).run()
 
 
 if __name__ == "__main__":
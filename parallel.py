@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Tuple
+
+from snapshot import open_snapshot
+from shm_cache import SharedOutageCache
+from app import build_site_outages
+from log import logger, configure_worker_logging
+
+# set once in each worker process by _init_worker
+_outages = None
+_coalesce = False
+
+
+def _init_worker(
+    snapshot_path: str, cache_name: str, outages: list, coalesce: bool, log_level: int
+):
+    global _outages, _coalesce
+    configure_worker_logging(log_level)
+    if snapshot_path:
+        _outages = open_snapshot(snapshot_path)
+    elif cache_name:
+        _outages = SharedOutageCache.attach(cache_name)
+    else:
+        _outages = outages
+    _coalesce = coalesce
+
+
+def _build_site(site_id: str, site_info: dict) -> Tuple[str, List[dict]]:
+    return site_id, build_site_outages(_outages, site_info, coalesce=_coalesce)
+
+
+def build_sites_parallel(
+    outages: List[dict],
+    site_infos: Dict[str, dict],
+    workers: int = None,
+    coalesce: bool = False,
+    snapshot_path: str = None,
+) -> Iterator[Tuple[str, List[dict], Exception]]:
+    """
+    Build the site outages of many sites in a process pool.
+
+    The outages are put once into a SharedOutageCache(or an existing snapshot file is used) that every worker
+    attaches to when it starts, so only the site info of a site is sent with each task and only its site outages
+    come back. Outages that the snapshot layout cannot store(timestamps in another format than
+    '2022-01-01T00:00:00.000Z') are copied to each worker when it starts instead.
+
+    Args:
+        outages (List[dict]): The outages, a list or an OutageSnapshot.
+        site_infos (Dict[str, dict]): Site infos by site id.
+        workers (int): The number of worker processes, the number of CPUs if not given.
+        coalesce (bool): Merge the overlapping outages of each device before the join.
+        snapshot_path (str): Snapshot file that already holds exactly these outages, so it is not written again.
+
+    Yields:
+        (site_id, site outages, error) tuples in the order the sites are finished. A failing site doesn't stop
+        the others, its site outages are None and error is the exception raised in the worker.
+    """
+    cache = None
+    if not snapshot_path:
+        try:
+            cache = SharedOutageCache.create(outages)
+        except ValueError as e:
+            logger.warning(
+                "Outages are not shared, they are copied to each worker",
+                extra={"fields": {"error": e}},
+            )
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(
+                snapshot_path,
+                cache and cache.name,
+                None if snapshot_path or cache else outages,
+                coalesce,
+                logger.getEffectiveLevel(),
+            ),
+        ) as pool:
+            futures = {
+                pool.submit(_build_site, site_id, site_info): site_id
+                for site_id, site_info in site_infos.items()
+            }
+
+            for future in as_completed(futures):
+                try:
+                    yield (*future.result(), None)
+                except Exception as e:
+                    yield futures[future], None, e
+    finally:
+        if cache:
+            cache.unlink()
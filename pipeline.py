@@ -0,0 +1,168 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from app import get_site_info, post_outages, build_site_outages, SKIPPED
+
+# put into a queue once for every worker of the next stage when there is no more work
+_DONE = object()
+
+
+class Stage:
+    """
+    A pipeline stage, `workers` threads take items from `inbox`, run `func` and put the results to `outbox`.
+
+    The queues are bounded, so a slow stage blocks the stages before it instead of piling up their results.
+
+    Args:
+        name (str): Name of the stage in the stats.
+        func (Callable): Function that takes an item and returns the item for the next stage.
+        workers (int): Number of threads of the stage.
+        inbox (queue.Queue): The queue to read from.
+        outbox (queue.Queue): The queue to write to, None for the last stage.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        workers: int,
+        inbox: queue.Queue,
+        outbox: queue.Queue = None,
+    ):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.next_workers = 0
+
+        self.busy_seconds = 0.0
+        self.processed = 0
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._running = workers
+
+    def work(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                break
+
+            site_id = item[0]
+            start = time.perf_counter()
+            try:
+                result = self.func(*item)
+            except Exception as e:
+                result = None
+                with self._lock:
+                    self.errors[site_id] = e
+            busy = time.perf_counter() - start
+
+            with self._lock:
+                self.busy_seconds += busy
+                self.processed += 1
+
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+
+        # the last worker tells the workers of the next stage to stop
+        if last and self.outbox is not None:
+            for _ in range(self.next_workers):
+                self.outbox.put(_DONE)
+
+
+def run_pipeline(
+    site_ids: List[str],
+    outages: List[dict],
+    headers: dict,
+    fetch_workers: int = 4,
+    transform_workers: int = 2,
+    upload_workers: int = 4,
+    queue_size: int = 8,
+    coalesce: bool = False,
+) -> dict:
+    """
+    Post the site outages of many sites with the fetch, transform and upload steps of different sites overlapping.
+
+    Each site goes through three stages connected by bounded queues: fetching the site info, building the site
+    outages and posting them. Every stage runs on its own thread pool, so the site info of one site is fetched and
+    another site is joined while a third one is posted.
+
+    Args:
+        site_ids (List[str]): The sites to post.
+        outages (List[dict]): The outages, fetched once for all sites.
+        headers (dict): Headers to include in the requests.
+        fetch_workers (int): Threads fetching site infos.
+        transform_workers (int): Threads building the site outages.
+        upload_workers (int): Threads posting the site outages.
+        queue_size (int): Max number of items waiting between two stages.
+        coalesce (bool): Merge the overlapping outages of each device before the join.
+
+    Returns:
+        Stats of the run: "wall_seconds", "posted" site ids, "skipped" site ids(see `app.use_ledger`),
+        "errors" by site id and for each stage
+        "workers", "processed", "busy_seconds" and "utilization"(busy time / (workers * wall time)).
+    """
+
+    def fetch(site_id):
+        return site_id, get_site_info(site_id=site_id, headers=headers)
+
+    def transform(site_id, site_info):
+        return site_id, build_site_outages(outages, site_info, coalesce=coalesce)
+
+    def upload(site_id, data):
+        r = post_outages(site_id=site_id, data=data, headers=headers)
+        if r is None:
+            raise Exception(f"Post of site {site_id} failed")
+        (skipped if r is SKIPPED else posted).append(site_id)
+
+    posted = []
+    skipped = []
+    site_queue = queue.Queue()
+    info_queue = queue.Queue(maxsize=queue_size)
+    data_queue = queue.Queue(maxsize=queue_size)
+
+    stages = [
+        Stage("fetch", fetch, fetch_workers, site_queue, info_queue),
+        Stage("transform", transform, transform_workers, info_queue, data_queue),
+        Stage("upload", upload, upload_workers, data_queue),
+    ]
+    for stage, next_stage in zip(stages, stages[1:]):
+        stage.next_workers = next_stage.workers
+
+    for site_id in site_ids:
+        site_queue.put((site_id,))
+    for _ in range(stages[0].workers):
+        site_queue.put(_DONE)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sum(s.workers for s in stages)) as pool:
+        for stage in stages:
+            for _ in range(stage.workers):
+                pool.submit(stage.work)
+    wall_seconds = time.perf_counter() - start
+
+    errors = {}
+    stats = {"wall_seconds": wall_seconds, "posted": posted, "skipped": skipped}
+    for stage in stages:
+        errors.update(stage.errors)
+        stats[stage.name] = {
+            "workers": stage.workers,
+            "processed": stage.processed,
+            "busy_seconds": stage.busy_seconds,
+            "utilization": (
+                stage.busy_seconds / (stage.workers * wall_seconds)
+                if wall_seconds
+                else 0.0
+            ),
+        }
+    stats["errors"] = errors
+
+    return stats
@@ -0,0 +1,97 @@
+import sys
+from multiprocessing import shared_memory
+from typing import Any, List
+
+from snapshot import OutageSnapshot, snapshot_to_bytes
+
+
+class SharedOutageCache:
+    """
+    Outages stored once in shared memory in the snapshot layout, so worker processes can query them without
+    having their own copy.
+
+    The process that creates the cache owns it and must call `unlink` when the workers are done, the workers
+    `attach` by name and read the columns directly from the shared memory. A cache can be given to
+    `filter_by_column` and `filter_by_another_json` like a list of outages.
+
+    Use `create` or `attach` instead of the constructor.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        # workers get a read-only view, only the owner writes the outages once in `create`
+        self.outages = OutageSnapshot(shm.buf.toreadonly())
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @classmethod
+    def create(cls, outages: List[dict]) -> "SharedOutageCache":
+        """
+        Put the outages into a new shared memory block.
+
+        Args:
+            outages (List[dict]): Outages with id, begin and end fields, as returned by `get_outages`.
+
+        Returns:
+            The cache, its `name` is used by the workers to attach.
+
+        Raises:
+            ValueError: If a timestamp cannot be stored without changing its text, see `snapshot_to_bytes`.
+        """
+        data = snapshot_to_bytes(outages)
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[: len(data)] = data
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedOutageCache":
+        """
+        Attach to a cache created by another process.
+
+        Args:
+            name (str): The name of the cache.
+
+        Returns:
+            A read-only cache.
+        """
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # before 3.13 attaching registers the block to the resource tracker again. Processes started by
+            # multiprocessing share the tracker of the creating process, so that is harmless for them, but an
+            # unrelated process attaching would free the block when it exits.
+            shm = shared_memory.SharedMemory(name=name)
+
+        return cls(shm, owner=False)
+
+    def __len__(self) -> int:
+        return len(self.outages)
+
+    def __iter__(self):
+        return iter(self.outages)
+
+    def iter_chunks(self, size: int):
+        """Yield the outages as lists of at most `size` dicts, see `OutageSnapshot.iter_chunks`."""
+        return self.outages.iter_chunks(size)
+
+    def filter_by_column(self, column: str, value: Any, op: str) -> OutageSnapshot:
+        """Filter the outages like `app.filter_by_column`, see `OutageSnapshot.filter_by_column`."""
+        return self.outages.filter_by_column(column, value, op)
+
+    def close(self):
+        """
+        Detach from the shared memory.
+
+        The views returned by `filter_by_column` must be released before, they read from the shared memory.
+        """
+        self.outages = None
+        self.shm.close()
+
+    def unlink(self):
+        """Close and free the shared memory, only the owner should call it."""
+        self.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,255 @@
+import mmap
+import operator
+import struct
+from typing import Any, Iterator, List, Union
+
+import numpy as np
+
+# Layout of a snapshot (little endian, every section starts at a multiple of 8 bytes):
+#   header      : magic(8 bytes) + row count, device id count, device id blob size (3 x uint64)
+#   begin       : int64[rows]            epoch milliseconds
+#   end         : int64[rows]            epoch milliseconds
+#   id_code     : uint32[rows]           index into the device id dictionary
+#   id_offsets  : uint32[device ids + 1] start/end of each device id in the blob
+#   id_blob     : utf-8 device ids
+_MAGIC = b"KFOSNAP1"
+_HEADER = struct.Struct("<8sQQQ")
+
+_OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "<": operator.lt,
+    "=": operator.eq,
+}
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def _to_epoch_ms(values: Union[str, List[str]]) -> np.ndarray:
+    """Convert ISO timestamps like '2022-01-01T00:00:00.000Z' to epoch milliseconds."""
+    values = np.atleast_1d(np.asarray(values, dtype=str))
+    values = np.char.rstrip(values, "Z")
+    return values.astype("datetime64[ms]").astype(np.int64)
+
+
+def _to_iso(values: np.ndarray) -> np.ndarray:
+    """Convert epoch milliseconds to ISO timestamps like '2022-01-01T00:00:00.000Z'."""
+    return np.char.add(
+        np.datetime_as_string(values.astype("datetime64[ms]"), unit="ms"), "Z"
+    )
+
+
+def snapshot_to_bytes(outages: List[dict]) -> bytes:
+    """
+    Encode a list of outages in the columnar snapshot layout.
+
+    Args:
+        outages (List[dict]): Outages with id, begin and end fields, as returned by `get_outages`.
+
+    Returns:
+        The encoded snapshot.
+
+    Raises:
+        ValueError: If a timestamp cannot be stored without changing its text.
+    """
+    ids = [row["id"] for row in outages]
+    begins = [row["begin"] for row in outages]
+    ends = [row["end"] for row in outages]
+
+    dictionary, codes = np.unique(np.asarray(ids, dtype=str), return_inverse=True)
+    begin = _to_epoch_ms(begins) if outages else np.empty(0, dtype=np.int64)
+    end = _to_epoch_ms(ends) if outages else np.empty(0, dtype=np.int64)
+
+    # the timestamps are posted back as text, so they must come back exactly the same
+    if outages and (list(_to_iso(begin)) != begins or list(_to_iso(end)) != ends):
+        raise ValueError(
+            "Timestamps must be in 'YYYY-MM-DDTHH:MM:SS.sssZ' format to be stored in a snapshot"
+        )
+
+    encoded_ids = [device_id.encode("utf-8") for device_id in dictionary]
+    id_offsets = np.zeros(len(encoded_ids) + 1, dtype=np.uint32)
+    np.cumsum([len(device_id) for device_id in encoded_ids], out=id_offsets[1:])
+    id_blob = b"".join(encoded_ids)
+
+    sections = [
+        begin.astype("<i8").tobytes(),
+        end.astype("<i8").tobytes(),
+        codes.astype("<u4").tobytes(),
+        id_offsets.astype("<u4").tobytes(),
+        id_blob,
+    ]
+
+    out = bytearray(_HEADER.pack(_MAGIC, len(outages), len(encoded_ids), len(id_blob)))
+    for section in sections:
+        out += b"\0" * (_align(len(out)) - len(out))
+        out += section
+
+    return bytes(out)
+
+
+def write_snapshot(outages: List[dict], path: str) -> None:
+    """
+    Write a list of outages to a snapshot file.
+
+    Args:
+        outages (List[dict]): Outages with id, begin and end fields, as returned by `get_outages`.
+        path (str): Path of the snapshot file.
+    """
+    with open(path, "wb") as f:
+        f.write(snapshot_to_bytes(outages))
+
+
+def open_snapshot(path: str) -> "OutageSnapshot":
+    """
+    Memory-map a snapshot file.
+
+    Args:
+        path (str): Path of the snapshot file.
+
+    Returns:
+        An `OutageSnapshot` reading the columns directly from the mapped file.
+    """
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            raise ValueError(f"{path} is not an outage snapshot")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return OutageSnapshot(buffer)
+
+
+class OutageSnapshot:
+    """
+    Read-only view of outages stored in the snapshot layout.
+
+    The columns are numpy views on the given buffer(bytes, mmap or shared memory), nothing is parsed or copied
+    when the snapshot is opened. Filtering returns a new view that shares the same columns, so the filters can be
+    chained like `filter_by_column` calls. Iterating yields the outages as dicts like `get_outages` returns them,
+    so a snapshot can be given to `filter_by_column`, `filter_by_another_json` and `create_df`.
+
+    Args:
+        buffer: A buffer holding a snapshot created by `snapshot_to_bytes`.
+        rows (np.ndarray): Positions of the rows in the view, all rows if not given.
+    """
+
+    def __init__(self, buffer, rows: np.ndarray = None):
+        magic, n_rows, n_ids, blob_size = _HEADER.unpack_from(buffer, 0)
+        if magic != _MAGIC:
+            raise ValueError("Buffer is not an outage snapshot")
+
+        self._buffer = buffer
+        offset = _HEADER.size
+
+        columns = {}
+        for name, dtype, count in (
+            ("begin", "<i8", n_rows),
+            ("end", "<i8", n_rows),
+            ("id_code", "<u4", n_rows),
+            ("id_offsets", "<u4", n_ids + 1),
+        ):
+            offset = _align(offset)
+            columns[name] = np.frombuffer(
+                buffer, dtype=dtype, count=count, offset=offset
+            )
+            offset += columns[name].nbytes
+
+        offset = _align(offset)
+        blob = bytes(memoryview(buffer)[offset : offset + blob_size])
+        id_offsets = columns.pop("id_offsets")
+        self.device_ids = [
+            blob[id_offsets[i] : id_offsets[i + 1]].decode("utf-8")
+            for i in range(n_ids)
+        ]
+
+        self.columns = columns
+        self.rows = rows
+
+    def _column(self, name: str) -> np.ndarray:
+        column = self.columns[name]
+        return column if self.rows is None else column[self.rows]
+
+    def _view(self, mask: np.ndarray) -> "OutageSnapshot":
+        positions = np.flatnonzero(mask)
+        rows = positions if self.rows is None else self.rows[positions]
+        return self._view_rows(rows)
+
+    def _view_rows(self, rows: np.ndarray) -> "OutageSnapshot":
+        view = object.__new__(OutageSnapshot)
+        view._buffer = self._buffer
+        view.device_ids = self.device_ids
+        view.columns = self.columns
+        view.rows = rows
+        return view
+
+    def __len__(self) -> int:
+        return len(self.columns["begin"]) if self.rows is None else len(self.rows)
+
+    def __iter__(self):
+        return iter(self.to_records())
+
+    def iter_chunks(self, size: int) -> Iterator[List[dict]]:
+        """
+        Yield the outages of the view as lists of at most `size` dicts, so only one chunk is built at a time.
+
+        Args:
+            size (int): Number of outages in a chunk.
+        """
+        for start in range(0, len(self), size):
+            positions = np.arange(start, min(start + size, len(self)))
+            rows = positions if self.rows is None else self.rows[positions]
+            yield self._view_rows(rows).to_records()
+
+    def to_records(self) -> List[dict]:
+        """Return the outages of the view as a list of dicts."""
+        ids = np.asarray(self.device_ids, dtype=object)[self._column("id_code")]
+        begins = _to_iso(self._column("begin"))
+        ends = _to_iso(self._column("end"))
+
+        return [
+            {"id": device_id, "begin": begin, "end": end}
+            for device_id, begin, end in zip(ids, begins.tolist(), ends.tolist())
+        ]
+
+    def filter_by_column(self, column: str, value: Any, op: str) -> "OutageSnapshot":
+        """
+        Filter the outages like `app.filter_by_column` but on the columns.
+
+        Args:
+            column (str): filter column, one of "id", "begin", "end"
+            value (Any): The value to compare against.
+            op (str): The comparison operator to use. Allowed values are: ">", ">=", "<=", "<", "=", "in".
+
+        Returns:
+            A new `OutageSnapshot` view with the matching outages.
+
+        Raises:
+            ValueError: If the comparison operator is not allowed.
+            KeyError: If the column is not in the snapshot.
+        """
+        if op != "in" and op not in _OPERATORS:
+            raise ValueError("Operation is not allowed")
+
+        if column == "id":
+            # the operation is run once per device id, the rows only pick up the result by their codes
+            if op == "in":
+                values = value if isinstance(value, str) else set(value)
+                matches = np.array(
+                    [device_id in values for device_id in self.device_ids], dtype=bool
+                )
+            else:
+                matches = np.array(
+                    [_OPERATORS[op](device_id, value) for device_id in self.device_ids],
+                    dtype=bool,
+                )
+            return self._view(matches[self._column("id_code")])
+
+        if column not in self.columns:
+            raise KeyError(column)
+
+        data = self._column(column)
+        if op == "in":
+            return self._view(np.isin(data, _to_epoch_ms(list(value))))
+
+        return self._view(_OPERATORS[op](data, _to_epoch_ms(value)[0]))
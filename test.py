@@ -3,16 +3,55 @@ from app import (
     get,
     get_site_info,
     filter_by_column,
+    filter_by_another_json,
     _API,
     get_x_api_key,
     get_outages,
+    get_outages_paginated,
+    HTTPStatusError,
     parse_json,
     df_join,
+    is_sorted,
+    create_interval_index,
+    filter_by_interval,
+    coalesce_outages,
     df_to_json,
     create_df,
+    create_typed_dfs,
     post,
     post_outages,
+    get_single_flight_stats,
+    fingerprint,
+    load_state,
+    save_state,
+    diff_outages,
+    build_site_outages,
+    use_ledger,
+    SKIPPED,
 )
+from main import run_delta, run_many
+from parallel import build_sites_parallel
+from shm_cache import SharedOutageCache
+from pipeline import run_pipeline
+import chunked
+from chunked import build_site_outages_chunked
+from log import configure_logging, configure_worker_logging, logger, stop_logging
+import io
+import tracing
+from watch import Watcher
+import codec
+import breaker
+from breaker import CircuitBreaker, CircuitOpenError
+import app
+from ledger import PostLedger
+from cassette import RecordingAdapter, ReplayAdapter, CassetteMiss, install
+from snapshot import OutageSnapshot, open_snapshot, write_snapshot, snapshot_to_bytes
+import os
+import tempfile
+import zipfile
+import threading
+import time
+from unittest import mock
 import requests
 import json
 import requests_mock
@@ -22,6 +61,10 @@ import pandas as pd
 class testapp(unittest.TestCase):
     maxDiff = None
 
+    def setUp(self):
+        # every test starts with closed circuits
+        breaker.reset()
+
     def test_get_raises_value_error_when_endpoint_not_provided(self):
         with self.assertRaises(ValueError):
             r = get()
@@ -621,6 +664,1290 @@ class testapp(unittest.TestCase):
         # Check the response
         assert response.status_code == 200
 
+    def test_fingerprint_ignores_key_order(self):
+        first = [{"id": "1", "begin": "2022-01-01T00:00:00.000Z"}]
+        second = [{"begin": "2022-01-01T00:00:00.000Z", "id": "1"}]
+
+        self.assertEqual(fingerprint(first), fingerprint(second))
+        self.assertNotEqual(fingerprint(first), fingerprint(first + first))
+
+    def test_save_and_load_state(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state.json")
+
+            self.assertEqual(load_state(path), {"sites": {}})
+
+            state = {"sites": {"norwich-pear-tree": {"payload_fingerprint": "abc"}}}
+            save_state(state, path)
+
+            self.assertEqual(load_state(path), state)
+
+    def test_diff_outages(self):
+        previous = [
+            {
+                "id": "1",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+            {
+                "id": "2",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+        ]
+        current = [
+            {
+                "id": "1",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "3",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+        ]
+
+        delta = diff_outages(previous, current)
+
+        self.assertEqual(delta["added"], [current[1]])
+        self.assertEqual(delta["removed"], [previous[1]])
+        self.assertEqual(delta["changed"], [current[0]])
+
+    def test_run_delta_skips_post_when_nothing_changed(self):
+        outages = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "2",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+        ]
+        site_info = {
+            "id": "site",
+            "name": "Site",
+            "devices": [{"id": "1", "name": "Battery 1"}],
+        }
+        state = {"sites": {}}
+
+        with requests_mock.Mocker() as m:
+            m.post(f"{_API}/site-outages/site", status_code=200)
+
+            run_delta("site", outages, site_info, state, headers={})
+            run_delta("site", outages, site_info, state, headers={})
+
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(
+                state["sites"]["site"]["payload"],
+                [
+                    {
+                        "id": "1",
+                        "name": "Battery 1",
+                        "begin": "2022-02-01T00:00:00.000Z",
+                        "end": "2022-03-01T00:00:00.000Z",
+                    }
+                ],
+            )
+
+            outages[0]["end"] = "2022-04-01T00:00:00.000Z"
+            run_delta("site", outages, site_info, state, headers={})
+
+            self.assertEqual(m.call_count, 2)
+
+    def test_watcher_posts_only_when_outages_change(self):
+        outages = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+        site_info = {
+            "id": "site",
+            "name": "Site",
+            "devices": [{"id": "1", "name": "Battery 1"}],
+        }
+
+        with requests_mock.Mocker() as m:
+            outages_mock = m.get(
+                f"{_API}/outages",
+                [
+                    {"json": outages, "headers": {"ETag": '"v1"'}},
+                    {"status_code": 304},
+                ],
+            )
+            site_info_mock = m.get(f"{_API}/site-info/site", json=site_info)
+            post_mock = m.post(f"{_API}/site-outages/site", status_code=200)
+
+            watcher = Watcher(["site"], headers={}, interval=0)
+            watcher.run(max_cycles=2)
+
+            self.assertEqual(outages_mock.call_count, 2)
+            self.assertEqual(
+                outages_mock.request_history[1].headers["If-None-Match"], '"v1"'
+            )
+            self.assertEqual(site_info_mock.call_count, 1)
+            self.assertEqual(post_mock.call_count, 1)
+            self.assertEqual(len(watcher.cycle_latencies), 2)
+
+    def test_watcher_retries_failed_sites_in_next_cycle(self):
+        v1 = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+        v2 = v1 + [
+            {
+                "id": "1",
+                "begin": "2022-04-01T00:00:00.000Z",
+                "end": "2022-05-01T00:00:00.000Z",
+            }
+        ]
+        site_info = {"id": "site", "devices": [{"id": "1", "name": "Battery 1"}]}
+
+        with requests_mock.Mocker() as m, mock.patch("app.time.sleep"):
+            m.get(
+                f"{_API}/outages",
+                [
+                    {"json": v1, "headers": {"ETag": '"v1"'}},
+                    {"json": v2, "headers": {"ETag": '"v2"'}},
+                    {"status_code": 304},
+                    {"status_code": 304},
+                ],
+            )
+            m.get(f"{_API}/site-info/site", json=site_info)
+            m.get(f"{_API}/site-info/missing", status_code=404)
+            post_mock = m.post(
+                f"{_API}/site-outages/site",
+                [{"status_code": 200}, {"status_code": 503}, {"status_code": 200}],
+            )
+
+            watcher = Watcher(["missing", "site"], headers={}, interval=0)
+            posted = [watcher.run_cycle() for _ in range(4)]
+
+        # the missing site fails every cycle without stopping the other site
+        self.assertEqual(posted, [["site"], [], ["site"], []])
+        self.assertEqual(post_mock.call_count, 3)
+        self.assertEqual(len(post_mock.request_history[2].json()), 2)
+        self.assertEqual(watcher.pending_sites, {"missing"})
+
+    def test_snapshot_round_trip(self):
+        outages = [
+            {
+                "id": "b",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.123Z",
+            },
+            {
+                "id": "a",
+                "begin": "2021-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "b",
+                "begin": "2023-02-01T00:00:00.000Z",
+                "end": "2024-03-01T00:00:00.000Z",
+            },
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "outages.snapshot")
+            write_snapshot(outages, path)
+            snapshot = open_snapshot(path)
+
+            self.assertEqual(len(snapshot), 3)
+            self.assertEqual(list(snapshot), outages)
+            self.assertEqual(snapshot.device_ids, ["a", "b"])
+
+    def test_snapshot_filter_by_column_matches_list_filter(self):
+        outages = [
+            {
+                "id": "b",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.123Z",
+            },
+            {
+                "id": "a",
+                "begin": "2021-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "b",
+                "begin": "2023-02-01T00:00:00.000Z",
+                "end": "2024-03-01T00:00:00.000Z",
+            },
+        ]
+        snapshot = OutageSnapshot(snapshot_to_bytes(outages))
+
+        for column, value, op in (
+            ("begin", "2022-01-01T00:00:00.000Z", ">="),
+            ("end", "2022-03-01T00:00:00.000Z", "="),
+            ("id", ["a"], "in"),
+            ("id", "a", ">"),
+        ):
+            self.assertEqual(
+                list(filter_by_column(snapshot, column, value, op)),
+                filter_by_column(outages, column, value, op),
+            )
+
+        filtered = filter_by_column(snapshot, "begin", "2022-01-01T00:00:00.000Z", ">=")
+        self.assertEqual(
+            list(filter_by_column(filtered, "id", ["b"], "in")),
+            [outages[0], outages[2]],
+        )
+
+        with self.assertRaises(ValueError):
+            filter_by_column(snapshot, "begin", "2022-01-01T00:00:00.000Z", "invalid")
+
+    def test_snapshot_raises_value_error_for_unknown_timestamp_format(self):
+        with self.assertRaises(ValueError):
+            snapshot_to_bytes([{"id": "a", "begin": "2022-01-01", "end": "2022-01-02"}])
+
+    def test_codec_loads_bytes_and_str(self):
+        text = '[{"id": "1", "name": "Battery \u00e7", "begin": "2022-01-01T00:00:00.000Z"}]'
+
+        self.assertEqual(codec.loads(text.encode("utf-8")), json.loads(text))
+        self.assertEqual(codec.loads(text), json.loads(text))
+        self.assertEqual(parse_json(text.encode("utf-8")), json.loads(text))
+        self.assertEqual(codec.loads(codec.dumps(json.loads(text))), json.loads(text))
+
+    def test_post_sends_json_body(self):
+        data = [{"id": "1", "name": "Battery 1", "begin": "2022-01-01T00:00:00.000Z"}]
+
+        with requests_mock.Mocker() as m:
+            m.post(f"{_API}/site-outages/site", status_code=200)
+
+            post(endpoint="site-outages/site", data=data, headers={"X-API-Key": "key"})
+
+            request = m.request_history[0]
+            self.assertEqual(request.headers["Content-Type"], "application/json")
+            self.assertEqual(request.headers["X-API-Key"], "key")
+            self.assertEqual(request.json(), data)
+
+    def test_df_join_merge_strategy_matches_hash_strategy(self):
+        df1 = pd.DataFrame(
+            {
+                "id": [3, 1, 2, 1, 4],
+                "begin": ["C", "B", "E", "A", "D"],
+            }
+        )
+        df2 = pd.DataFrame({"id": [2, 1, 3], "name": ["E", "D", "F"]})
+
+        hash_result = df_join(df1, df2, "id", "inner", ["id", "begin"])
+        merge_result = df_join(
+            df1, df2, "id", "inner", ["id", "begin"], strategy="merge"
+        )
+
+        pd.testing.assert_frame_equal(
+            merge_result.reset_index(drop=True), hash_result.reset_index(drop=True)
+        )
+
+    def test_df_join_raises_value_error_for_unknown_strategy(self):
+        df1 = pd.DataFrame({"id": [1], "begin": ["A"]})
+        df2 = pd.DataFrame({"id": [1], "name": ["D"]})
+
+        with self.assertRaises(ValueError):
+            df_join(df1, df2, "id", "inner", ["id"], strategy="invalid")
+
+        with self.assertRaises(ValueError):
+            df_join(df1, df2, "id", "left", ["id"], strategy="merge")
+
+    def test_is_sorted(self):
+        df = pd.DataFrame({"id": [1, 1, 2], "begin": ["B", "C", "A"]})
+
+        self.assertTrue(is_sorted(df, ["id", "begin"]))
+        self.assertFalse(is_sorted(df, ["begin"]))
+        self.assertFalse(is_sorted(df.iloc[[1, 0, 2]], ["id", "begin"]))
+        self.assertTrue(is_sorted(df.iloc[:0], ["id"]))
+
+    def test_df_join_outer_with_device_without_outages(self):
+        outages = create_df(
+            [
+                {
+                    "id": "b",
+                    "begin": "2022-02-01T00:00:00.000Z",
+                    "end": "2022-03-01T00:00:00.000Z",
+                },
+                {
+                    "id": "a",
+                    "begin": "2022-01-01T00:00:00.000Z",
+                    "end": "2022-02-01T00:00:00.000Z",
+                },
+                {
+                    "id": "a",
+                    "begin": "2021-01-01T00:00:00.000Z",
+                    "end": "2021-02-01T00:00:00.000Z",
+                },
+            ]
+        )
+        devices = create_df(
+            [
+                {"id": "a", "name": "Battery 1"},
+                {"id": "b", "name": "Battery 2"},
+                {"id": "c", "name": "Battery 3"},
+            ]
+        )
+
+        for type in ("outer", "left"):
+            # the outages are the right side of the join, so device c has NaN begin
+            expected = (
+                devices.set_index("id")
+                .join(outages.set_index("id"), how=type)
+                .reset_index()
+                .sort_values(by=["id", "begin"])
+            )
+            actual = df_join(outages, devices, "id", type, ["id", "begin"])
+
+            self.assertEqual(df_to_json(actual), df_to_json(expected))
+            self.assertEqual(actual["id"].tolist(), ["a", "a", "b", "c"])
+
+    def test_filter_by_interval(self):
+        input_data = [
+            {
+                "id": "0101e9d3-ab78-408a-b54f-2a4b88efe048",
+                "begin": "2022-11-21T12:05:03.195Z",
+                "end": "2022-11-30T18:22:19.422Z",
+            },
+            {
+                "id": "05e353d8-96f2-4906-bc91-0b869b9a4a6c",
+                "begin": "2022-07-05T08:15:39.279Z",
+                "end": "2022-08-16T18:09:54.458Z",
+            },
+            {
+                "id": "0b4a44f2-3f7f-4a62-b3e3-56d487b5900b",
+                "begin": "2021-03-21T15:03:47.019Z",
+                "end": "2022-01-18T14:24:44.651Z",
+            },
+        ]
+        index = create_interval_index(input_data)
+
+        self.assertEqual(
+            filter_by_interval(index, "2022-01-01T00:00:00.000Z"), [input_data[2]]
+        )
+        self.assertEqual(
+            filter_by_interval(
+                index, "2022-01-18T14:24:44.651Z", "2022-07-05T08:15:39.279Z"
+            ),
+            [input_data[1], input_data[2]],
+        )
+        self.assertEqual(
+            filter_by_interval(
+                input_data, "2022-09-01T00:00:00.000Z", "2022-10-01T00:00:00.000Z"
+            ),
+            [],
+        )
+
+        with self.assertRaises(ValueError):
+            filter_by_interval(
+                index, "2022-10-01T00:00:00.000Z", "2022-09-01T00:00:00.000Z"
+            )
+
+    def test_interval_index_matches_full_scan(self):
+        input_data = [
+            {
+                "id": str(i),
+                "begin": f"{(i * 37) % 1000:04d}",
+                "end": f"{(i * 37) % 1000 + i % 50:04d}",
+            }
+            for i in range(500)
+        ]
+        index = create_interval_index(input_data)
+
+        for begin, end in (
+            ("0000", "0000"),
+            ("0100", "0120"),
+            ("0990", "1100"),
+            ("0500", "0500"),
+        ):
+            expected = [
+                row for row in input_data if row["begin"] <= end and row["end"] >= begin
+            ]
+            self.assertEqual(filter_by_interval(index, begin, end), expected)
+
+    def test_coalesce_outages(self):
+        input_data = [
+            {
+                "id": "b",
+                "begin": "2022-03-01T00:00:00.000Z",
+                "end": "2022-04-01T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-01-15T00:00:00.000Z",
+                "end": "2022-01-20T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-05-01T00:00:00.000Z",
+                "end": "2022-06-01T00:00:00.000Z",
+            },
+            {
+                "id": "b",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+        ]
+
+        expected_data = [
+            {
+                "id": "a",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-05-01T00:00:00.000Z",
+                "end": "2022-06-01T00:00:00.000Z",
+            },
+            {
+                "id": "b",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+            {
+                "id": "b",
+                "begin": "2022-03-01T00:00:00.000Z",
+                "end": "2022-04-01T00:00:00.000Z",
+            },
+        ]
+
+        coalesced, eliminated = coalesce_outages(input_data)
+
+        self.assertEqual(coalesced, expected_data)
+        self.assertEqual(eliminated, 2)
+        self.assertEqual(input_data[1]["end"], "2022-02-01T00:00:00.000Z")
+
+    def test_build_sites_parallel_matches_sequential(self):
+        outages = [
+            {
+                "id": str(i % 7),
+                "begin": f"2022-0{i % 9 + 1}-01T00:00:00.000Z",
+                "end": "2023-01-01T00:00:00.000Z",
+            }
+            for i in range(100)
+        ]
+        site_infos = {
+            "site-a": {
+                "id": "site-a",
+                "devices": [
+                    {"id": "1", "name": "Battery 1"},
+                    {"id": "2", "name": "Battery 2"},
+                ],
+            },
+            "site-b": {"id": "site-b", "devices": [{"id": "5", "name": "Battery 5"}]},
+        }
+
+        actual = {
+            site_id: data
+            for site_id, data, error in build_sites_parallel(
+                outages, site_infos, workers=2
+            )
+        }
+
+        self.assertEqual(
+            actual,
+            {
+                site_id: build_site_outages(outages, site_info)
+                for site_id, site_info in site_infos.items()
+            },
+        )
+
+    def test_build_sites_parallel_copies_outages_the_cache_cannot_store(self):
+        outages = [
+            {"id": "1", "begin": "2022-02-01T00:00:00Z", "end": "2022-03-01T00:00:00Z"},
+            {"id": "2", "begin": "2022-02-01", "end": "2022-03-01"},
+        ]
+        site_infos = {
+            "site-a": {"id": "site-a", "devices": [{"id": "1", "name": "Battery 1"}]},
+            "site-b": {"id": "site-b", "devices": [{"id": "2", "name": "Battery 2"}]},
+        }
+        with self.assertRaises(ValueError):
+            SharedOutageCache.create(outages)
+
+        actual = {
+            site_id: (data, error)
+            for site_id, data, error in build_sites_parallel(
+                outages, site_infos, workers=2
+            )
+        }
+
+        self.assertEqual(
+            actual,
+            {
+                site_id: (build_site_outages(outages, site_info), None)
+                for site_id, site_info in site_infos.items()
+            },
+        )
+
+    def test_run_many_posts_every_site(self):
+        outages = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+            {
+                "id": "2",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+        ]
+
+        with requests_mock.Mocker() as m, mock.patch.dict(
+            os.environ, {"X_API_KEY": "key"}
+        ):
+            m.get(f"{_API}/outages", json=outages)
+            for site_id, device_id in (("site-a", "1"), ("site-b", "2")):
+                m.get(
+                    f"{_API}/site-info/{site_id}",
+                    json={
+                        "id": site_id,
+                        "devices": [{"id": device_id, "name": "Battery"}],
+                    },
+                )
+            post_a = m.post(f"{_API}/site-outages/site-a", status_code=200)
+            post_b = m.post(f"{_API}/site-outages/site-b", status_code=200)
+
+            run_many(["site-a", "site-b"], workers=2)
+
+            self.assertEqual(post_a.last_request.json()[0]["id"], "1")
+            self.assertEqual(post_b.last_request.json()[0]["id"], "2")
+
+    def test_run_many_posts_other_sites_when_one_fails(self):
+        outages = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+
+        with requests_mock.Mocker() as m, mock.patch.dict(
+            os.environ, {"X_API_KEY": "key"}
+        ):
+            m.get(f"{_API}/outages", json=outages)
+            # the site info of site-a has no devices, so its join fails in the worker
+            m.get(f"{_API}/site-info/site-a", json={"id": "site-a"})
+            m.get(
+                f"{_API}/site-info/site-b",
+                json={"id": "site-b", "devices": [{"id": "1", "name": "Battery"}]},
+            )
+            post_b = m.post(f"{_API}/site-outages/site-b", status_code=200)
+
+            errors = run_many(["site-a", "site-b"], workers=2)
+
+        self.assertEqual(list(errors), ["site-a"])
+        self.assertIsInstance(errors["site-a"], KeyError)
+        self.assertEqual(post_b.call_count, 1)
+
+    def test_run_many_posts_other_sites_when_a_site_info_fails(self):
+        outages = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+
+        with requests_mock.Mocker() as m, mock.patch.dict(
+            os.environ, {"X_API_KEY": "key"}
+        ):
+            m.get(f"{_API}/outages", json=outages)
+            m.get(f"{_API}/site-info/site-a", status_code=404)
+            m.get(
+                f"{_API}/site-info/site-b",
+                json={"id": "site-b", "devices": [{"id": "1", "name": "Battery"}]},
+            )
+            post_b = m.post(f"{_API}/site-outages/site-b", status_code=200)
+
+            errors = run_many(["site-a", "site-b"], workers=2)
+
+        self.assertEqual(list(errors), ["site-a"])
+        self.assertIsInstance(errors["site-a"], HTTPStatusError)
+        self.assertEqual(post_b.call_count, 1)
+
+    def test_shared_outage_cache(self):
+        outages = [
+            {
+                "id": "b",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.123Z",
+            },
+            {
+                "id": "a",
+                "begin": "2021-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            },
+        ]
+        cache = SharedOutageCache.create(outages)
+
+        try:
+            attached = SharedOutageCache.attach(cache.name)
+
+            self.assertEqual(list(attached), outages)
+            self.assertEqual(
+                list(
+                    filter_by_column(
+                        attached, "begin", "2022-01-01T00:00:00.000Z", ">="
+                    )
+                ),
+                [outages[0]],
+            )
+            self.assertEqual(
+                list(
+                    filter_by_another_json(
+                        {"devices": [{"id": "a"}]}, "devices", "id", attached
+                    )
+                ),
+                [outages[1]],
+            )
+
+            with self.assertRaises(ValueError):
+                attached.outages.columns["begin"][0] = 0
+
+            attached.close()
+        finally:
+            cache.unlink()
+
+    def test_get_outages_coalesces_concurrent_calls(self):
+        outages = [
+            {
+                "id": "1",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+
+        def slow_response(request, context):
+            time.sleep(0.3)
+            return outages
+
+        with requests_mock.Mocker() as m:
+            outages_mock = m.get(f"{_API}/outages", json=slow_response)
+            before = get_single_flight_stats()
+            results = []
+
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(
+                        get_outages(headers={"X-API-Key": "key"})
+                    )
+                )
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            after = get_single_flight_stats()
+
+            self.assertEqual(outages_mock.call_count, 1)
+            self.assertEqual(results, [outages] * 4)
+            self.assertEqual(after["calls"] - before["calls"], 4)
+            self.assertEqual(after["coalesced"] - before["coalesced"], 3)
+
+            get_outages(headers={"X-API-Key": "key"})
+            self.assertEqual(outages_mock.call_count, 2)
+
+    def test_run_pipeline_posts_every_site(self):
+        outages = [
+            {
+                "id": str(i),
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+            for i in range(5)
+        ]
+        site_ids = [f"site-{i}" for i in range(5)]
+
+        with requests_mock.Mocker() as m:
+            for i, site_id in enumerate(site_ids):
+                m.get(
+                    f"{_API}/site-info/{site_id}",
+                    json={
+                        "id": site_id,
+                        "devices": [{"id": str(i), "name": f"Battery {i}"}],
+                    },
+                )
+                m.post(f"{_API}/site-outages/{site_id}", status_code=200)
+            m.get(f"{_API}/site-info/site-broken", status_code=404)
+
+            stats = run_pipeline(
+                site_ids + ["site-broken"], outages, headers={}, queue_size=1
+            )
+
+            self.assertEqual(sorted(stats["posted"]), site_ids)
+            self.assertEqual(list(stats["errors"]), ["site-broken"])
+            self.assertEqual(stats["fetch"]["processed"], 6)
+            self.assertEqual(stats["transform"]["processed"], 5)
+            self.assertEqual(stats["upload"]["processed"], 5)
+            for stage in ("fetch", "transform", "upload"):
+                self.assertTrue(0 <= stats[stage]["utilization"] <= 1)
+
+            for i, site_id in enumerate(site_ids):
+                posted = [
+                    r
+                    for r in m.request_history
+                    if r.method == "POST" and r.path.endswith(site_id)
+                ]
+                self.assertEqual(posted[0].json()[0]["id"], str(i))
+
+    def test_build_site_outages_chunked_matches_in_memory(self):
+        outages = [
+            {
+                "id": str(i % 7),
+                "begin": f"2022-{i % 12 + 1:02d}-{i % 28 + 1:02d}T00:00:00.000Z",
+                "end": "2023-01-01T00:00:00.000Z",
+            }
+            for i in range(300)
+        ]
+        site_info = {
+            "id": "site",
+            "devices": [
+                {"id": "1", "name": "Battery 1"},
+                {"id": "3", "name": "Battery 3"},
+                {"id": "6", "name": "Battery 6"},
+            ],
+        }
+        expected = build_site_outages(outages, site_info)
+
+        for memory_budget in (1, 50_000, 10_000_000):
+            self.assertEqual(
+                build_site_outages_chunked(outages, site_info, memory_budget), expected
+            )
+
+        snapshot = OutageSnapshot(snapshot_to_bytes(outages))
+        self.assertEqual(
+            build_site_outages_chunked(snapshot, site_info, 50_000), expected
+        )
+        self.assertEqual(build_site_outages_chunked([], site_info, 50_000), [])
+
+        # with a budget of 1 byte every chunk is spilled, they are merged 3 files at a time
+        open_files = [0, 0]
+        read_spilled = chunked._read_spilled
+
+        def counting_read_spilled(path):
+            open_files[0] += 1
+            open_files[1] = max(open_files)
+            try:
+                yield from read_spilled(path)
+            finally:
+                open_files[0] -= 1
+
+        with mock.patch("chunked._MAX_MERGE_FILES", 3), mock.patch(
+            "chunked._read_spilled", counting_read_spilled
+        ):
+            self.assertEqual(
+                build_site_outages_chunked(outages, site_info, 1), expected
+            )
+        self.assertLessEqual(open_files[1], 3)
+
+    def test_request_logs_are_structured_and_sampled(self):
+        stream = io.StringIO()
+        configure_logging(success_sample_rate=1.0, stream=stream)
+
+        try:
+            with requests_mock.Mocker() as m:
+                m.get(f"{_API}/outages", [{"status_code": 500}, {"status_code": 200}])
+                get(endpoint="outages", wait_time_in_seconds=0)
+        finally:
+            stop_logging()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("WARNING", lines[0])
+        self.assertIn("method=GET endpoint=outages status=500", lines[0])
+        self.assertIn("attempt=1", lines[0])
+        self.assertIn("INFO Request finished", lines[1])
+        self.assertIn("status=200", lines[1])
+        self.assertIn("attempt=2", lines[1])
+
+        stream = io.StringIO()
+        configure_logging(success_sample_rate=0.0, stream=stream)
+
+        try:
+            with requests_mock.Mocker() as m:
+                m.get(f"{_API}/outages", status_code=200)
+                get(endpoint="outages")
+        finally:
+            stop_logging()
+
+        self.assertEqual(stream.getvalue(), "")
+
+    def test_request_logs_keep_the_worker_handlers(self):
+        handlers, level, propagate = logger.handlers, logger.level, logger.propagate
+        stream = io.StringIO()
+        configure_worker_logging(stream=stream)
+
+        try:
+            with requests_mock.Mocker() as m:
+                m.get(f"{_API}/outages", [{"status_code": 500}, {"status_code": 200}])
+                get(endpoint="outages", wait_time_in_seconds=0)
+        finally:
+            logger.handlers, logger.level, logger.propagate = (
+                handlers,
+                level,
+                propagate,
+            )
+
+        self.assertIn("WARNING Request failed", stream.getvalue())
+        self.assertIn("status=500", stream.getvalue())
+
+    def test_run_delta_logs_structured_events(self):
+        outages = [
+            {
+                "id": "a",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+        site_info = {"id": "site", "devices": [{"id": "a", "name": "Battery 1"}]}
+        state = {"sites": {}}
+
+        stream = io.StringIO()
+        configure_logging(stream=stream)
+        try:
+            with mock.patch("main.post_outages", return_value=mock.Mock()):
+                run_delta("site", outages, site_info, state, headers={})
+                run_delta("site", outages, site_info, state, headers={})
+        finally:
+            stop_logging()
+
+        lines = stream.getvalue().splitlines()
+        self.assertIn(
+            "INFO Site outages changed site_id=site added=1 removed=0 changed=0",
+            lines[0],
+        )
+        self.assertIn("INFO No outage changes, post skipped site_id=site", lines[1])
+
+    def test_tracing_records_nested_spans(self):
+        tracing.clear()
+        tracing.enable()
+
+        try:
+            with requests_mock.Mocker() as m, mock.patch("app.time.sleep"):
+                m.get(f"{_API}/outages", [{"status_code": 500}, {"json": []}])
+                get_outages(headers={})
+        finally:
+            tracing.disable()
+
+        spans = {s.id: s for s in tracing.get_spans()}
+        names = [s.name for s in spans.values()]
+        self.assertEqual(names.count("get"), 2)
+        self.assertIn("get_outages", names)
+        self.assertIn("parse_json", names)
+
+        retry = next(
+            s
+            for s in spans.values()
+            if s.name == "get" and s.attributes["attempt"] == 2
+        )
+        first = spans[retry.parent_id]
+        self.assertEqual(first.name, "get")
+        self.assertEqual(first.attributes["status"], 500)
+        self.assertEqual(retry.attributes["status"], 200)
+        self.assertEqual(spans[first.parent_id].name, "get_outages")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            chrome_path = os.path.join(tmp_dir, "trace.json")
+            tracing.export_chrome_trace(chrome_path)
+            with open(chrome_path) as f:
+                self.assertEqual(len(json.load(f)["traceEvents"]), len(spans))
+
+            jsonl_path = os.path.join(tmp_dir, "trace.jsonl")
+            tracing.export_json_lines(jsonl_path)
+            with open(jsonl_path) as f:
+                self.assertEqual(len(f.readlines()), len(spans))
+
+        tracing.clear()
+        create_df([])
+        self.assertEqual(tracing.get_spans(), [])
+
+    def test_typed_dfs_join_matches_plain_dfs(self):
+        outages = [
+            {
+                "id": "b",
+                "begin": "2022-03-01T00:00:00.000Z",
+                "end": "2022-04-01T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-05-01T10:00:00.123Z",
+                "end": "2022-06-01T00:00:00.000Z",
+            },
+            {
+                "id": "c",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+            {
+                "id": "a",
+                "begin": "2022-01-01T00:00:00.000Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            },
+        ]
+        devices = [{"id": "b", "name": "Battery 2"}, {"id": "a", "name": "Battery 1"}]
+
+        df_outages, df_devices = create_typed_dfs(outages, devices)
+
+        self.assertIsInstance(df_outages["id"].dtype, pd.CategoricalDtype)
+        self.assertEqual(df_outages["id"].dtype, df_devices["id"].dtype)
+        self.assertIsInstance(df_devices["name"].dtype, pd.CategoricalDtype)
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(df_outages["begin"]))
+
+        expected = df_to_json(
+            df_join(
+                create_df(outages), create_df(devices), "id", "inner", ["id", "begin"]
+            )
+        )
+        for strategy in ("hash", "merge", "auto"):
+            result = df_join(
+                df_outages,
+                df_devices,
+                "id",
+                "inner",
+                ["id", "begin"],
+                strategy=strategy,
+            )
+            self.assertEqual(df_to_json(result), expected)
+
+    def test_typed_dfs_keep_timestamps_in_other_formats(self):
+        outages = [
+            {
+                "id": "a",
+                "begin": "2022-01-01T00:00:00Z",
+                "end": "2022-02-01T00:00:00.000Z",
+            }
+        ]
+        devices = [{"id": "a", "name": "Battery 1"}]
+
+        df_outages, df_devices = create_typed_dfs(outages, devices)
+
+        self.assertFalse(pd.api.types.is_datetime64_any_dtype(df_outages["begin"]))
+        self.assertEqual(df_outages["end"].dtype, "datetime64[ms]")
+        self.assertEqual(
+            df_to_json(df_join(df_outages, df_devices, "id", "inner", ["id", "begin"])),
+            [dict(outages[0], name="Battery 1")],
+        )
+
+    def test_get_outages_paginated_merges_pages_in_order(self):
+        outages = [
+            {"id": str(i), "begin": "2022-01-01T00:00:00.000Z"} for i in range(7)
+        ]
+        failed = set()
+
+        def page(request, context):
+            offset = int(request.qs["offset"][0])
+            limit = int(request.qs["limit"][0])
+            # the second page fails once, only it is fetched again
+            if offset == 2 and offset not in failed:
+                failed.add(offset)
+                context.status_code = 500
+                return []
+            return outages[offset : offset + limit]
+
+        with requests_mock.Mocker() as m, mock.patch("app.time.sleep"):
+            m.get(f"{_API}/outages", json=page)
+            actual = get_outages(headers={}, page_size=2, workers=3)
+
+        self.assertEqual(actual, outages)
+        offsets = [int(r.qs["offset"][0]) for r in m.request_history]
+        self.assertEqual(sorted(offsets), [0, 2, 2, 4, 6, 8, 10])
+
+    def test_get_outages_paginated_raises_when_page_keeps_failing(self):
+        with requests_mock.Mocker() as m, mock.patch("app.time.sleep") as sleep:
+            m.get(f"{_API}/outages", status_code=500)
+            with self.assertRaises(Exception):
+                get_outages_paginated(
+                    headers={}, page_size=2, workers=1, max_page_retry=2
+                )
+
+        # the page is retried with backoff, get doesn't retry it too
+        self.assertEqual(len(m.request_history), 3)
+        self.assertEqual(sleep.call_args_list, [mock.call(1.0), mock.call(2.0)])
+
+    def test_get_outages_paginated_falls_back_when_server_ignores_paging(self):
+        outages = [
+            {"id": str(i), "begin": "2022-01-01T00:00:00.000Z"} for i in range(7)
+        ]
+
+        # a page longer than the page size, and a page repeating the page before it
+        for page_size in (5, 7):
+            with requests_mock.Mocker() as m:
+                m.get(f"{_API}/outages", json=outages)
+                actual = get_outages(headers={}, page_size=page_size, workers=4)
+
+            self.assertEqual(actual, outages)
+            # one wave of pages and the single fetch
+            self.assertEqual(m.call_count, 5)
+
+    def test_get_outages_paginated_stops_after_max_pages(self):
+        def page(request, context):
+            offset = int(request.qs["offset"][0])
+            return [{"id": str(offset + i)} for i in range(2)]
+
+        with requests_mock.Mocker() as m:
+            m.get(f"{_API}/outages", json=page)
+            with self.assertRaises(Exception):
+                get_outages_paginated(headers={}, page_size=2, workers=1, max_pages=3)
+
+        self.assertEqual(m.call_count, 3)
+
+    def test_get_outages_page_does_not_retry_client_errors(self):
+        with requests_mock.Mocker() as m, mock.patch("app.time.sleep"):
+            m.get(f"{_API}/outages", status_code=403)
+            with self.assertRaises(HTTPStatusError) as raised:
+                get_outages_paginated(headers={}, page_size=2, workers=1)
+
+        self.assertEqual(raised.exception.status_code, 403)
+        self.assertEqual(m.call_count, 1)
+
+    def test_post_raises_client_errors_without_retries_left(self):
+        with requests_mock.Mocker() as m:
+            m.post(f"{_API}/site-outages/norwich-pear-tree", status_code=404)
+            with self.assertRaises(HTTPStatusError) as raised:
+                post(
+                    endpoint="site-outages/norwich-pear-tree",
+                    data=[{"id": "a"}],
+                    max_retry=0,
+                )
+
+        self.assertEqual(raised.exception.status_code, 404)
+        self.assertEqual(m.call_count, 1)
+
+    def test_cassette_replays_recorded_run(self):
+        outages = [{"id": "a", "begin": "2022-01-01T00:00:00.000Z"}]
+        site_url = f"{_API}/site-outages/norwich-pear-tree"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "run.cassette")
+
+            server = requests_mock.Adapter()
+            server.register_uri(
+                "GET", f"{_API}/outages", [{"status_code": 500}, {"json": outages}]
+            )
+            server.register_uri("POST", site_url, json={})
+
+            with mock.patch("app._session", requests.Session()), mock.patch(
+                "app.time.sleep"
+            ):
+                recorder = install(RecordingAdapter(path, inner=server))
+                recorded = get_outages(headers={"X-API-Key": "secret"})
+                post_outages("norwich-pear-tree", outages, headers={})
+                recorder.save()
+
+            self.assertEqual(len(recorder.exchanges), 3)
+            post_exchange = recorder.exchanges[2]
+            self.assertEqual(post_exchange["method"], "POST")
+            with zipfile.ZipFile(path) as archive:
+                self.assertEqual(
+                    json.loads(archive.read(post_exchange["request_body"])), outages
+                )
+                info = archive.getinfo(post_exchange["request_body"])
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertIsNone(recorder.exchanges[0]["request_body"])
+            with open(path, "rb") as f:
+                self.assertNotIn(b"secret", f.read())
+
+            with mock.patch("app._session", requests.Session()), mock.patch(
+                "app.time.sleep"
+            ) as sleep:
+                install(ReplayAdapter(path, latency="zero"))
+                replayed = get_outages(headers={})
+                response = post_outages("norwich-pear-tree", outages, headers={})
+
+                # every recorded exchange is served once
+                with self.assertRaises(CassetteMiss):
+                    app._session.get(f"{_API}/outages")
+
+            self.assertEqual(replayed, recorded)
+            self.assertEqual(response.status_code, 200)
+            # only the retry of get waited, not the replayed requests
+            self.assertEqual(sleep.call_count, 1)
+
+    def test_cassette_replays_with_original_latency(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "run.cassette")
+
+            server = requests_mock.Adapter()
+            server.register_uri("GET", f"{_API}/outages", json=[])
+            session = requests.Session()
+            recorder = install(RecordingAdapter(path, inner=server), session)
+            session.get(f"{_API}/outages")
+            recorder.exchanges[0]["elapsed"] = 0.25
+            recorder.save()
+
+            session = requests.Session()
+            install(ReplayAdapter(path), session)
+            with mock.patch("cassette.time.sleep") as sleep:
+                response = session.get(f"{_API}/outages")
+
+        sleep.assert_called_once_with(0.25)
+        self.assertEqual(response.json(), [])
+
+    def test_ledger_shares_the_state_file(self):
+        outages = [
+            {
+                "id": "a",
+                "begin": "2022-02-01T00:00:00.000Z",
+                "end": "2022-03-01T00:00:00.000Z",
+            }
+        ]
+        site_info = {"id": "site", "devices": [{"id": "a", "name": "Battery 1"}]}
+        url = f"{_API}/site-outages/site"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state.json")
+            try:
+                with requests_mock.Mocker() as m:
+                    m.post(url, json={})
+
+                    ledger = PostLedger(path)
+                    use_ledger(ledger)
+                    state = load_state(path)
+                    run_delta("site", outages, site_info, state, headers={})
+                    save_state(state, path)
+                    ledger.save()
+
+                    # a new ledger knows the payload posted by run_delta
+                    use_ledger(PostLedger(path))
+                    skipped = post_outages(
+                        "site", build_site_outages(outages, site_info)
+                    )
+            finally:
+                use_ledger(None)
+
+            saved = load_state(path)["sites"]["site"]
+
+        self.assertIs(skipped, SKIPPED)
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(saved["payload_fingerprint"], fingerprint(saved["payload"]))
+        self.assertIn("snapshot_fingerprint", saved)
+
+    def test_post_sends_same_idempotency_key_on_retry(self):
+        data = [{"id": "a", "name": "Battery 1"}]
+        url = f"{_API}/site-outages/norwich-pear-tree"
+
+        with requests_mock.Mocker() as m, mock.patch("app.time.sleep"):
+            m.post(url, [{"status_code": 500}, {"json": {}}, {"json": {}}])
+            post_outages("norwich-pear-tree", data, headers={})
+            # a new post of the same payload is not a retry
+            post_outages("norwich-pear-tree", data, headers={})
+
+        keys = [r.headers["Idempotency-Key"] for r in m.request_history]
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[1], keys[2])
+
+    def test_ledger_skips_payloads_already_posted(self):
+        data = [{"id": "a", "name": "Battery 1"}]
+        url = f"{_API}/site-outages/norwich-pear-tree"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "ledger.json")
+            try:
+                with requests_mock.Mocker() as m:
+                    m.post(url, json={})
+
+                    use_ledger(PostLedger(path))
+                    self.assertEqual(
+                        post_outages("norwich-pear-tree", data).status_code, 200
+                    )
+                    app._ledger.save()
+
+                    # a new run reads the ledger file
+                    ledger = PostLedger(path)
+                    use_ledger(ledger)
+                    skipped = post_outages("norwich-pear-tree", data)
+                    post_outages("norwich-pear-tree", data + [{"id": "b"}])
+                    # the site changed in between, so the first payload is posted again
+                    post_outages("norwich-pear-tree", data)
+            finally:
+                use_ledger(None)
+
+        self.assertIs(skipped, SKIPPED)
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(ledger.stats["requests_saved"], 1)
+        self.assertEqual(ledger.stats["bytes_saved"], len(codec.dumps(data)))
+
+    def test_circuit_breaker_states(self):
+        now = [0.0]
+        circuit = CircuitBreaker(
+            failure_threshold=2, reset_timeout=10, clock=lambda: now[0]
+        )
+
+        circuit.record_failure()
+        circuit.record_success()
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            circuit.before_request()
+
+        now[0] = 10
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+        circuit.before_request()
+        # only one probe at a time
+        with self.assertRaises(CircuitOpenError):
+            circuit.before_request()
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+
+        now[0] = 20
+        circuit.before_request()
+        circuit.record_success()
+        self.assertEqual(
+            circuit.stats,
+            {"state": "closed", "trips": 2, "rejected": 2, "consecutive_failures": 0},
+        )
+
+    def test_get_fails_fast_when_circuit_is_open(self):
+        with requests_mock.Mocker() as m, mock.patch("app.time.sleep") as sleep:
+            m.get(f"{_API}/site-info/a", status_code=500)
+            m.get(f"{_API}/site-info/b", status_code=500)
+            m.get(f"{_API}/site-info/c", exc=requests.exceptions.ConnectTimeout)
+
+            with self.assertRaises(CircuitOpenError):
+                get(endpoint="site-info/a", max_retry=10)
+            # the other sites of the endpoint share the circuit
+            with self.assertRaises(CircuitOpenError):
+                get(endpoint="site-info/b")
+
+        self.assertEqual(m.call_count, 5)
+        self.assertEqual(sleep.call_count, 5)
+        stats = breaker.get_breaker_stats()["site-info"]
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["trips"], 1)
+        self.assertEqual(stats["rejected"], 2)
+
+        breaker.reset()
+        with requests_mock.Mocker() as m:
+            m.get(f"{_API}/site-info/c", exc=requests.exceptions.ConnectTimeout)
+            with self.assertRaises(requests.exceptions.ConnectTimeout):
+                get(endpoint="site-info/c")
+        self.assertEqual(
+            breaker.get_breaker_stats()["site-info"]["consecutive_failures"], 1
+        )
+
 
 if __name__ == "__main__":
     """To run the py directly"""
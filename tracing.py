@@ -0,0 +1,191 @@
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from typing import List
+
+_enabled = False
+_spans = []
+_spans_lock = threading.Lock()
+_ids = itertools.count(1)
+_local = threading.local()
+
+
+class Span:
+    """
+    A timed operation with attributes. Spans started while another span of the same thread is open are its children.
+
+    Use `span` or `traced` to create spans.
+    """
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.id = next(_ids)
+        self.parent_id = None
+        self.thread_id = threading.get_ident()
+        self.start = None
+        self.end = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        stack = _stack()
+        if stack:
+            self.parent_id = stack[-1].id
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        _stack().pop()
+        with _spans_lock:
+            _spans.append(self)
+        return False
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class _NoopSpan:
+    """Returned when tracing is disabled, it records nothing."""
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def enable() -> None:
+    """Start recording spans."""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Stop recording spans, the recorded spans are kept until `clear` is called."""
+    global _enabled
+    _enabled = False
+
+
+def clear() -> None:
+    """Forget the recorded spans."""
+    with _spans_lock:
+        _spans.clear()
+
+
+def get_spans() -> List[Span]:
+    """Return the finished spans in the order they are finished."""
+    with _spans_lock:
+        return list(_spans)
+
+
+def span(name: str, **attributes):
+    """
+    Create a span to use as a context manager, e.g. `with span("join", rows=10): ...`
+
+    Args:
+        name (str): Name of the span.
+        **attributes: Attributes of the span.
+
+    Returns:
+        A Span, or a shared no-op span if tracing is disabled.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+
+def current_span():
+    """Return the innermost open span of this thread, or a no-op span if there is none."""
+    if not _enabled:
+        return _NOOP_SPAN
+    stack = _stack()
+    return stack[-1] if stack else _NOOP_SPAN
+
+
+def traced(name: str = None):
+    """
+    Decorator that runs the function in a span named after the function.
+
+    Args:
+        name (str): Name of the span, the function name if not given.
+    """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def export_json_lines(path: str) -> None:
+    """
+    Write the finished spans to a file, one JSON object per line.
+
+    Args:
+        path (str): Path of the file.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for s in get_spans():
+            record = {
+                "id": s.id,
+                "parent_id": s.parent_id,
+                "name": s.name,
+                "thread_id": s.thread_id,
+                "start": s.start,
+                "duration": s.duration,
+                "attributes": s.attributes,
+            }
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def export_chrome_trace(path: str) -> None:
+    """
+    Write the finished spans in the Chrome trace event format, which can be opened in chrome://tracing or Perfetto.
+
+    Args:
+        path (str): Path of the file.
+    """
+    events = [
+        {
+            "name": s.name,
+            "ph": "X",
+            "ts": s.start * 1_000_000,
+            "dur": s.duration * 1_000_000,
+            "pid": os.getpid(),
+            "tid": s.thread_id,
+            "args": s.attributes,
+        }
+        for s in get_spans()
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events}, f, default=str)
@@ -0,0 +1,201 @@
+import signal
+import threading
+import time
+from collections import deque
+from typing import List
+
+from app import (
+    get,
+    get_site_info,
+    parse_json,
+    post_outages,
+    SKIPPED,
+    fingerprint,
+    select_site_outages,
+    join_site_outages,
+)
+from log import logger
+
+
+class Watcher:
+    """
+    Keeps the process alive and posts the site outages whenever the outages of a site change.
+
+    The outages are polled with conditional requests(If-None-Match/If-Modified-Since), so an unchanged feed
+    costs one 304 response. Site infos and the last outage snapshot fingerprint of each site are kept in memory
+    between cycles, and only the sites whose outage snapshot changed are joined and posted again.
+
+    Args:
+        site_ids (List[str]): The site ids to watch.
+        headers (dict): Headers to include in the requests.
+        interval (float): Seconds to wait between two polls.
+        site_info_ttl (float): Seconds after which a cached site info is fetched again.
+        max_latencies (int): Number of the last cycle latencies to keep.
+    """
+
+    def __init__(
+        self,
+        site_ids: List[str],
+        headers: dict,
+        interval: float = 60,
+        site_info_ttl: float = 3600,
+        max_latencies: int = 1000,
+    ):
+        self.site_ids = site_ids
+        self.headers = headers
+        self.interval = interval
+        self.site_info_ttl = site_info_ttl
+
+        self.etag = None
+        self.last_modified = None
+        self.outages = None
+        self.site_infos = {}
+        self.site_info_fetched_at = {}
+        self.site_fingerprints = {}
+        # sites whose last post failed, they are built and posted again in the next cycle even if nothing changed
+        self.pending_sites = set()
+
+        self.cycle_latencies = deque(maxlen=max_latencies)
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        """Stop the watcher after the running cycle is finished."""
+        self._stop.set()
+
+    def fetch_outages(self) -> bool:
+        """
+        Fetch the outages if they are modified since the last poll.
+
+        Returns:
+            True if new outages are fetched, False if the feed is not modified.
+        """
+        headers = dict(self.headers)
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        r = get(endpoint="outages", headers=headers)
+
+        if r.status_code == 304 and self.outages is not None:
+            return False
+
+        self.etag = r.headers.get("ETag")
+        self.last_modified = r.headers.get("Last-Modified")
+        self.outages = parse_json(r.content)
+        return True
+
+    def site_info(self, site_id: str) -> dict:
+        """Return the site info from the cache, fetch it if it is not cached or it is expired."""
+        fetched_at = self.site_info_fetched_at.get(site_id)
+
+        if fetched_at is None or time.monotonic() - fetched_at > self.site_info_ttl:
+            self.site_infos[site_id] = get_site_info(
+                site_id=site_id, headers=self.headers
+            )
+            self.site_info_fetched_at[site_id] = time.monotonic()
+
+        return self.site_infos[site_id]
+
+    def run_cycle(self) -> List[str]:
+        """
+        Run one poll cycle and post the outages of the affected sites.
+
+        A site that fails(its site info, join or post) is logged and tried again in the next cycle,
+        the other sites of the cycle are still posted.
+
+        Returns:
+            The ids of the sites whose outages are posted in this cycle.
+        """
+        start = time.perf_counter()
+        posted_sites = []
+
+        changed = self.fetch_outages()
+
+        for site_id in self.site_ids:
+            try:
+                if self.run_site(site_id, changed):
+                    posted_sites.append(site_id)
+                    self.pending_sites.discard(site_id)
+            except Exception as e:
+                self.pending_sites.add(site_id)
+                logger.warning(
+                    "Watch site failed",
+                    extra={"fields": {"site_id": site_id, "error": e}},
+                )
+
+        latency = time.perf_counter() - start
+        self.cycle_latencies.append(latency)
+        logger.info(
+            "Watch cycle finished",
+            extra={
+                "fields": {
+                    "latency_ms": round(latency * 1000, 1),
+                    "posted_sites": ",".join(posted_sites) or "none",
+                }
+            },
+        )
+
+        return posted_sites
+
+    def run_site(self, site_id: str, outages_changed: bool) -> bool:
+        """
+        Post the outages of a site if its outage snapshot changed since the last successful post.
+
+        Returns:
+            True if the outages are posted, False if they are not changed or the ledger skipped them.
+
+        Raises:
+            Exception: If the post fails, the site is then pending.
+        """
+        fetched_at = self.site_info_fetched_at.get(site_id)
+        site_info = self.site_info(site_id)
+        site_info_refreshed = self.site_info_fetched_at[site_id] != fetched_at
+
+        if (
+            not outages_changed
+            and not site_info_refreshed
+            and site_id in self.site_fingerprints
+            and site_id not in self.pending_sites
+        ):
+            return False
+
+        site_outages = select_site_outages(self.outages, site_info)
+        site_fingerprint = fingerprint([site_outages, site_info["devices"]])
+
+        if self.site_fingerprints.get(site_id) == site_fingerprint:
+            return False
+
+        data = join_site_outages(site_outages, site_info)
+        r = post_outages(site_id=site_id, data=data, headers=self.headers)
+        if r is None:
+            raise Exception("post failed")
+
+        self.site_fingerprints[site_id] = site_fingerprint
+        # a payload skipped by the ledger is already on the server
+        return r is not SKIPPED
+
+    def run(self, max_cycles: int = None):
+        """
+        Run the cycles until `stop` is called, SIGINT/SIGTERM is received or `max_cycles` is reached.
+
+        Args:
+            max_cycles (int): The max number of cycles to run, runs forever if not given.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        cycles = 0
+        while not self._stop.is_set():
+            try:
+                self.run_cycle()
+            except Exception as e:
+                # a failing cycle should not kill the watcher, the next cycle will try again
+                logger.warning("Watch cycle failed", extra={"fields": {"error": e}})
+
+            cycles += 1
+            if max_cycles is not None and cycles >= max_cycles:
+                break
+
+            self._stop.wait(self.interval)